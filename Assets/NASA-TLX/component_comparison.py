@@ -6,81 +6,195 @@
 
 import argparse
 import math
-import random
+import shlex
 import sys
 import numpy as np
-from itertools import permutations
 import json
 import os.path
-import hashlib
 
-if (__name__ == "__main__"):
+# Comparisions
+COMPARISIONS = [
+    ("Effort", "Performance"),
+    ("Temporal Demand", "Frustration"),
+    ("Temporal Demand", "Effort"),
+    ("Physical Demand", "Frustration"),
+    ("Performance", "Frustration"),
+    ("Physical Demand", "Temporal Demand"),
+    ("Physical Demand", "Performance"),
+    ("Temporal Demand", "Mental Demand"),
+    ("Frustration", "Effort"),
+    ("Performance", "Mental Demand"),
+    ("Performance", "Temporal Demand"),
+    ("Mental Demand", "Effort"),
+    ("Mental Demand", "Physical Demand"),
+    ("Effort", "Physical Demand"),
+    ("Frustration", "Mental Demand")
+]
+
+DEFAULT_SEED = 8734627
+BUNDLE_FILENAME = 'orders.json'
+
+
+def random_orders(num_participants, num_items, rng):
+    """
+    Returns a (participants, items) matrix where every row is an
+    independent random permutation of the item indices
+    """
+    return rng.permuted(np.tile(np.arange(num_items), (num_participants, 1)), axis=1)
+
+def williams_square(num_items, multiplier=1, mirror=False):
+    """
+    Returns the (items, items) Williams latin square whose first row is
+    0, 1, n-1, 2, n-2, ... multiplied by a unit modulo num_items.
+    Read backwards (mirror) for the second half of the design when
+    num_items is odd
+    """
+    columns = np.arange(num_items)
+    first_row = np.where(columns % 2 == 1, (columns + 1) // 2, (num_items - columns // 2) % num_items)
+    if (mirror):
+        first_row = first_row[::-1]
+    return (multiplier * first_row[np.newaxis, :] + columns[:, np.newaxis]) % num_items
+
+def balanced_orders(num_participants, num_items, rng):
+    """
+    Returns a (participants, items) matrix of Williams latin square rows:
+    every item appears in every position, and follows every other item,
+    equally often within each complete design (items rows, or 2 * items
+    rows if items is odd). Further participants get the rows of designs
+    built with other multipliers, so orders only repeat after all of them
+    are used. The items are randomly relabelled so the design does not
+    depend on the order of the comparisions
+    """
+    designs = []
+    for multiplier in range(1, max(num_items, 2)):
+        if (math.gcd(multiplier, num_items) != 1):
+            continue
+        # For odd num_items, the mirrored design of multiplier m holds the
+        # same rows as the design of n - m, so only half are needed
+        if (num_items % 2 == 1 and 2 * multiplier > num_items):
+            break
+        designs.append(williams_square(num_items, multiplier))
+        if (num_items % 2 == 1):
+            designs.append(williams_square(num_items, multiplier, mirror=True))
+    rows = np.concatenate(designs, axis=0)
+
+    if (num_participants > rows.shape[0]):
+        print('WARNING:: Only ({0}) balanced orders exist, some participants share an order'.format(rows.shape[0]))
+    labels = rng.permutation(num_items)
+    return labels[rows[np.arange(num_participants) % rows.shape[0]]]
+
+def get_ordering(index_order):
+    """
+    Returns the dictionary written to a participant's SUBJECT_N.json file
+    """
+    return { 'order': [{ 'component_a': COMPARISIONS[i][0], 'component_b': COMPARISIONS[i][1] } for i in index_order] }
 
+def write_file(file_path_name, text):
+    with open(file_path_name, 'w') as fp:
+        fp.write(text)
+
+def export_orderings(out_dir, participant_orders, workers=8):
+    """
+    Writes a SUBJECT_N.json file for every participant. Each file is
+    serialized in memory and written with a single call, spread across a
+    pool of threads
+    """
+    # Only imported when per-participant files are written
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(write_file, os.path.join(out_dir, 'SUBJECT_{0}.json'.format(participant)), json.dumps(get_ordering(index_order)))
+            for participant, index_order in enumerate(participant_orders)]
+        for future in futures:
+            future.result()
+
+def export_bundle(out_dir, participant_orders):
+    """
+    Writes the orderings of every participant to a single file, as a list
+    indexed by participant
+    """
+    file_path_name = os.path.join(out_dir, BUNDLE_FILENAME)
+    with open(file_path_name, 'w') as fp:
+        json.dump({ 'participants': [get_ordering(index_order) for index_order in participant_orders] }, fp)
+    return file_path_name
+
+def main(argv=None):
+    """
+    Runs the command line with the given arguments (sys.argv by default)
+    """
     # Get the command line args
     parser = argparse.ArgumentParser()
     parser.add_argument('participants', help='Number of participants to generate orderings for', type=int)
     parser.add_argument('out_dir', help='Directory to export to', type=str)
-    args = parser.parse_args()
+    parser.add_argument('--balanced', help='Use balanced (Williams latin square) orders instead of independent random ones', \
+        action='store_true', default=False)
+    parser.add_argument('--bundle', help='Write every ordering to a single {0} file instead of one file per participant'.format(BUNDLE_FILENAME), \
+        action='store_true', default=False)
+    parser.add_argument('--seed', help='Seed of the random number generator', type=int, default=DEFAULT_SEED)
+    parser.add_argument('--workers', help='Number of threads writing subject files', type=int, default=8)
+    args = parser.parse_args(argv)
 
     # Extract the args
     num_participants = args.participants
     out_dir = args.out_dir
 
-    # Comparisions
-    comparisions = [
-        ("Effort", "Performance"),
-        ("Temporal Demand", "Frustration"),
-        ("Temporal Demand", "Effort"),
-        ("Physical Demand", "Frustration"),
-        ("Performance", "Frustration"),
-        ("Physical Demand", "Temporal Demand"),
-        ("Physical Demand", "Performance"),
-        ("Temporal Demand", "Mental Demand"),
-        ("Frustration", "Effort"),
-        ("Performance", "Mental Demand"),
-        ("Performance", "Temporal Demand"),
-        ("Mental Demand", "Effort"),
-        ("Mental Demand", "Physical Demand"),
-        ("Effort", "Physical Demand"),
-        ("Frustration", "Mental Demand")
-    ]
-
-    # Generate orderings by creating orders using the indices
-    # of the comparison tuples above
-    participant_orders = np.zeros((num_participants, len(comparisions)), dtype=int)
-
-    # Seed the random number generator
-    seed = 8734627
-    np.random.seed(seed=seed)
-
-    # Shuffle index ordering using the seed defined above
-    for participant in range(num_participants):
-        participant_orders[participant,:] = np.arange(len(comparisions))
-        np.random.shuffle(participant_orders[participant,:])
-
-    
-    # Write the orderings out to files
-    for participant in range(num_participants):
-        index_order = participant_orders[participant,:]
-
-        ordering = { 'order': [] }
-        for i in range(len(index_order)):
-            ordering['order'].append({ 'component_a': comparisions[i][0], 'component_b': comparisions[i][1] })
+    # Generate orderings of the indices of the comparison tuples above
+    rng = np.random.default_rng(args.seed)
+    if (args.balanced):
+        participant_orders = balanced_orders(num_participants, len(COMPARISIONS), rng)
+    else:
+        participant_orders = random_orders(num_participants, len(COMPARISIONS), rng)
 
-        filename_w_extention = 'SUBJECT_{0}.json'.format(participant)
-        file_path_name = os.path.join(out_dir, filename_w_extention)
-        with open (file_path_name, 'w') as fp:
-            json.dump(ordering, fp)
+    # Write the orderings out to files
+    os.makedirs(out_dir, exist_ok=True)
+    if (args.bundle):
+        export_bundle(out_dir, participant_orders)
+    else:
+        export_orderings(out_dir, participant_orders, args.workers)
 
+def run_batch(batch_path):
     """
-    # Write the orderings out to files
-    for i in range(num_participants):
-        ordering = participant_orders[i,:]
-        filename_w_extention = 'SUBJECT_{0}.json'.format(i)
-        file_path_name = os.path.join(out_dir, filename_w_extention)
-        with open (file_path_name, 'w') as fp:
-            json.dump({ 'comparisions': ordering.tolist() }, fp)
+    Runs the command line once for every line of a file (- for stdin), e.g.
+        100 out/study_a --balanced
+    so any number of studies only pay for starting Python once. Blank lines
+    and # comments are skipped. A line that fails, whether its arguments
+    are rejected or the run raises, is reported and the others still run.
+    Kept here rather than shared with StimPresentationScripts/batch_runs.py
+    because the two tools do not share a directory.
+    Returns the number of lines that failed
     """
+    if (batch_path == '-'):
+        lines = sys.stdin.readlines()
+    else:
+        with open(batch_path, 'r') as fp:
+            lines = fp.readlines()
 
+    num_failed = 0
+    for line_number, line in enumerate(lines, 1):
+        try:
+            arguments = shlex.split(line, comments=True)
+        except ValueError as error:
+            # e.g. an unclosed quote
+            print('ERROR:: Line ({0}) could not be split: {1}'.format(line_number, error))
+            num_failed += 1
+            continue
+        if (len(arguments) == 0):
+            continue
+        print('[{0}] {1}'.format(line_number, ' '.join(arguments)))
+        try:
+            main(arguments)
+        except SystemExit as error:
+            # argparse exits on bad arguments after printing why
+            if (error.code not in (None, 0)):
+                print('ERROR:: Line ({0}) failed'.format(line_number))
+                num_failed += 1
+        except Exception as error:
+            print('ERROR:: Line ({0}) failed: {1}: {2}'.format(line_number, type(error).__name__, error))
+            num_failed += 1
+    return num_failed
 
-
+if (__name__ == "__main__"):
+    # python component_comparison.py batch studies.txt
+    if (len(sys.argv) == 3 and sys.argv[1] == 'batch'):
+        sys.exit(1 if run_batch(sys.argv[2]) > 0 else 0)
+    main()
@@ -0,0 +1,49 @@
+# batch_runs.py
+#
+# Runs a command line once for every line of a batch file, so scripts that
+# call a generator once per condition only start Python once
+
+import shlex
+import sys
+
+
+def read_batch_lines(batch_path):
+    """
+    Returns the lines of a batch file, or of stdin if batch_path is -
+    """
+    if (batch_path == '-'):
+        return sys.stdin.readlines()
+    with open(batch_path, 'r') as fp:
+        return fp.readlines()
+
+def run_batch(batch_path, run):
+    """
+    Calls run(arguments) with the arguments of every line of a batch file
+    (- for stdin). Blank lines and # comments are skipped. A line that
+    fails, whether argparse rejects its arguments or the run raises, is
+    reported and the remaining lines still run.
+    Returns the number of lines that failed
+    """
+    num_failed = 0
+    for line_number, line in enumerate(read_batch_lines(batch_path), 1):
+        try:
+            arguments = shlex.split(line, comments=True)
+        except ValueError as error:
+            # e.g. an unclosed quote
+            print('ERROR:: Line ({0}) could not be split: {1}'.format(line_number, error))
+            num_failed += 1
+            continue
+        if (len(arguments) == 0):
+            continue
+        print('[{0}] {1}'.format(line_number, ' '.join(arguments)))
+        try:
+            run(arguments)
+        except SystemExit as error:
+            # argparse exits on bad arguments after printing why
+            if (error.code not in (None, 0)):
+                print('ERROR:: Line ({0}) failed'.format(line_number))
+                num_failed += 1
+        except Exception as error:
+            print('ERROR:: Line ({0}) failed: {1}: {2}'.format(line_number, type(error).__name__, error))
+            num_failed += 1
+    return num_failed
@@ -0,0 +1,167 @@
+# benchmark_stim_presentation.py
+#
+# Times the presentation order generator over a grid of parameters and
+# saves the results as JSON. Results can be compared against a stored
+# baseline, in which case the script exits with an error if any case got
+# slower than the allowed tolerance
+
+import argparse
+import itertools
+import json
+import math
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import stim_presentation
+
+# Parameter grid: trials per block, number of stimuli, target percentage, participants
+FULL_GRID = {
+    'trials': [45, 90, 180],
+    'stimuli': [3, 4, 5],
+    'target_percentage': [0.2, 0.33],
+    'participants': [10, 100],
+}
+QUICK_GRID = {
+    'trials': [45],
+    'stimuli': [3],
+    'target_percentage': [0.33],
+    'participants': [10],
+}
+NUM_SEQUENCES = 15
+
+
+def measure(function, repeats):
+    """
+    Calls a function repeats times and returns (best wall time in seconds,
+    peak traced memory in bytes). Memory is traced on a separate call so
+    it does not slow down the timed ones
+    """
+    best = math.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak
+
+def run_pipeline(path, num_participants, num_sequences, num_stimuli, trials_per_block, target_trial_percentage):
+    """
+    Runs the same steps as the stim_presentation.py command line: block
+    orders, the design of every participant and exporting the subject files
+    """
+    target_trials_per_block = round(trials_per_block * target_trial_percentage)
+    block_orders = stim_presentation.get_block_orders(num_participants, num_sequences, num_stimuli)
+    stim_presentation.all_rows_unique(block_orders)
+    target_orders = stim_presentation.unrank_permutations(block_orders, num_stimuli)
+    generation_params = { 'trials_per_block': trials_per_block, 'target_trials_per_block': target_trials_per_block,
+        'target_trial_percentage': target_trial_percentage, 'max_rand_targets': 0 }
+    stim_presentation.export_participants(path, target_orders, generation_params, 'Pizza')
+
+def get_cases(grid, path):
+    """
+    Yields (name, parameters, function, trials generated per call) for
+    every benchmarked entry point and grid point. The loop variables are
+    bound as default arguments, so every function keeps its own grid point
+    even if it is called after the generator has moved on
+    """
+    for trials, num_stimuli, target_percentage in itertools.product(grid['trials'], grid['stimuli'], grid['target_percentage']):
+        num_targets = round(trials * target_percentage)
+        params = { 'trials': trials, 'stimuli': num_stimuli, 'target_percentage': target_percentage }
+
+        yield ('generate_block', params,
+            lambda trials=trials, num_targets=num_targets, target_percentage=target_percentage, num_stimuli=num_stimuli:
+                stim_presentation.generate_block(trials, num_targets, target_percentage, 0, num_stimuli, max_rand_targets=0), trials)
+        yield ('generate_target_stim_pairings', params,
+            lambda num_stimuli=num_stimuli, num_targets=num_targets: stim_presentation.generate_target_stim_pairings(num_stimuli, num_targets, True, 0), 0)
+
+        for num_participants in grid['participants']:
+            pipeline_params = dict(params, participants=num_participants)
+            yield ('pipeline', pipeline_params,
+                lambda num_participants=num_participants, num_stimuli=num_stimuli, trials=trials, target_percentage=target_percentage:
+                    run_pipeline(path, num_participants, NUM_SEQUENCES, num_stimuli, trials, target_percentage),
+                num_participants * NUM_SEQUENCES * num_stimuli * trials)
+
+    for num_stimuli in grid['stimuli']:
+        permutation_indices = np.arange(math.factorial(num_stimuli))
+        yield ('create_latin_square', { 'stimuli': num_stimuli }, lambda permutation_indices=permutation_indices: stim_presentation.create_latin_square(permutation_indices), 0)
+
+def run_benchmarks(grid, repeats=3):
+    """
+    Runs every case of the grid and returns a list of result dictionaries
+    """
+    random.seed('Pizza')
+    results = []
+    with tempfile.TemporaryDirectory() as path:
+        for name, params, function, num_trials in get_cases(grid, path):
+            result = { 'name': name, 'params': params }
+            try:
+                wall_time, peak_memory = measure(function, repeats)
+                result.update({ 'wall_time': wall_time, 'peak_memory': peak_memory })
+                if (num_trials > 0):
+                    result['trials_per_second'] = num_trials / wall_time if wall_time > 0 else math.inf
+            except Exception as error:
+                result['error'] = '{0}: {1}'.format(type(error).__name__, error)
+            results.append(result)
+            print('{0} {1}: {2}'.format(name, params, format_result(result)))
+    return results
+
+def format_result(result):
+    if ('error' in result):
+        return 'ERROR:: {0}'.format(result['error'])
+    text = '{0:.6f}s, {1:.1f} KiB peak'.format(result['wall_time'], result['peak_memory'] / 1024)
+    if ('trials_per_second' in result):
+        text += ', {0:.0f} trials/s'.format(result['trials_per_second'])
+    return text
+
+def get_case_key(result):
+    return json.dumps([result['name'], result['params']], sort_keys=True)
+
+def compare_results(results, baseline, tolerance):
+    """
+    Returns the list of cases that are more than tolerance (a fraction)
+    slower than the baseline, or that fail now but did not before
+    """
+    baseline_cases = { get_case_key(result): result for result in baseline['results'] }
+    regressions = []
+    for result in results:
+        previous = baseline_cases.get(get_case_key(result))
+        if (previous is None or 'error' in previous):
+            continue
+        if ('error' in result):
+            regressions.append('{0} {1}: now fails with {2}'.format(result['name'], result['params'], result['error']))
+        elif (result['wall_time'] > previous['wall_time'] * (1 + tolerance)):
+            regressions.append('{0} {1}: {2:.6f}s vs {3:.6f}s baseline'.format(result['name'], result['params'], result['wall_time'], previous['wall_time']))
+    return regressions
+
+if (__name__ == '__main__'):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--out', help='Path to save the results to', type=str, default='benchmark_results.json')
+    parser.add_argument('--baseline', help='Results of an earlier run to compare against', type=str, default=None)
+    parser.add_argument('--tolerance', help='Fraction a case may be slower than the baseline', type=float, default=0.25)
+    parser.add_argument('--repeats', help='Number of timed calls per case (the best is kept)', type=int, default=3)
+    parser.add_argument('--quick', help='Only run the smallest grid point', action='store_true', default=False)
+    args = parser.parse_args()
+
+    results = run_benchmarks(QUICK_GRID if args.quick else FULL_GRID, args.repeats)
+    report = { 'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': results }
+    with open(args.out, 'w') as fp:
+        json.dump(report, fp, indent=2)
+    print('Results written to {0}'.format(args.out))
+
+    if (args.baseline is not None):
+        with open(args.baseline, 'r') as fp:
+            regressions = compare_results(results, json.load(fp), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION:: {0}'.format(regression))
+        if (len(regressions) > 0):
+            sys.exit(1)
+        print('No regressions against {0}'.format(args.baseline))
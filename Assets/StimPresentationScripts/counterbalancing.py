@@ -0,0 +1,139 @@
+# counterbalancing.py
+#
+# Builds the block orders (the permutation of targets used in each
+# sequence) for every participant. Orders are given as indices into
+# itertools.permutations and can be turned into targets with
+# stim_presentation.unrank_permutations
+
+import math
+import numpy as np
+
+# Number of relabelled Williams designs in a row that may add no new rows
+# before design_block_orders falls back to random rows
+MAX_RELABEL_ATTEMPTS = 100
+
+
+def row_hashes(mat):
+    """
+    Returns the raw bytes of every row in a 2D array.
+    Equal rows have equal bytes, so they can be hashed in a set or dict
+    """
+    mat = np.ascontiguousarray(mat)
+    return [row.tobytes() for row in mat]
+
+def rows_unique(mat):
+    """
+    Returns true if all the rows of a 2D array are unique.
+    Runs in linear time by hashing the bytes of every row
+    """
+    seen = set()
+    for row in row_hashes(mat):
+        if (row in seen):
+            return False
+        seen.add(row)
+    return True
+
+def williams_row(num_items, num_columns, mirror=False):
+    """
+    Returns the first num_columns entries of the first row of a Williams
+    design over num_items items: 0, 1, n-1, 2, n-2, ...
+    The mirrored row is the same row read backwards
+    """
+    columns = np.arange(num_columns, dtype=np.int64)
+    if (mirror):
+        columns = num_items - 1 - columns
+    # Odd columns count up from 1, even columns count down from n
+    return np.where(columns % 2 == 1, (columns + 1) // 2, (num_items - columns // 2) % num_items)
+
+def williams_families(num_items):
+    """
+    Yields (multiplier, mirror) pairs, each of which describes a full
+    Williams design over num_items items.
+    Multiplying the first row by a unit modulo num_items keeps the differences
+    between neighbouring entries distinct, which is what makes every item
+    follow every other item equally often
+    """
+    for multiplier in range(1, max(num_items, 2)):
+        if (math.gcd(multiplier, num_items) != 1):
+            continue
+        yield multiplier, False
+        # Williams designs over an odd number of items need the mirrored rows
+        if (num_items % 2 == 1):
+            yield multiplier, True
+
+def williams_block_orders(num_items, num_columns, multiplier=1, mirror=False):
+    """
+    Returns the (num_items, num_columns) Williams design described by a
+    multiplier and mirror flag from williams_families
+    """
+    first_row = williams_row(num_items, num_columns, mirror)
+    offsets = np.arange(num_items, dtype=np.int64)[:, np.newaxis]
+    return (multiplier * first_row[np.newaxis, :] + offsets) % num_items
+
+def design_block_orders(num_participants, num_sequences, num_stimuli, rng=None):
+    """
+    Returns a (participants, sequences) matrix of unique block orders.
+    Participants are first assigned the rows of balanced Williams designs
+    over the num_stimuli! permutations, then the rows of the same designs
+    with the permutations randomly relabelled. Only rows no other
+    participant has are kept. If those run out, the remaining participants
+    get random orders that no other participant has.
+    A warning is printed if there are not enough distinct orders
+    """
+    if (rng is None):
+        rng = np.random.default_rng()
+
+    num_permutations = math.factorial(num_stimuli)
+    block_orders = np.zeros((num_participants, num_sequences), dtype=np.int64)
+    seen = set()
+    filled = 0
+
+    def add_rows(candidates):
+        nonlocal filled
+        for row in np.ascontiguousarray(candidates):
+            if (filled == num_participants):
+                break
+            key = row.tobytes()
+            if (key not in seen):
+                seen.add(key)
+                block_orders[filled] = row
+                filled += 1
+
+    def williams_designs():
+        # Each design is only built when the participants so far did not fill it
+        for multiplier, mirror in williams_families(num_permutations):
+            yield williams_block_orders(num_permutations, num_sequences, multiplier, mirror)
+
+    for design in williams_designs():
+        add_rows(design)
+        if (filled == num_participants):
+            break
+
+    # Relabelling the block orders of a Williams design keeps it balanced,
+    # so more balanced groups are drawn from random relabellings until
+    # they stop giving new rows
+    attempts_left = MAX_RELABEL_ATTEMPTS
+    while (filled < num_participants and attempts_left > 0):
+        labels = rng.permutation(num_permutations)
+        before = filled
+        for design in williams_designs():
+            add_rows(labels[design])
+            if (filled == num_participants):
+                break
+        attempts_left = MAX_RELABEL_ATTEMPTS if filled > before else attempts_left - 1
+
+    # Number of distinct orders that exist at all
+    num_possible = num_permutations ** num_sequences
+    if (filled < num_participants and len(seen) < num_possible):
+        # Draw random orders until every participant has a unique one.
+        # Only rows that have not been seen are kept, so each pass shrinks
+        # the number of participants left to fill
+        while (filled < num_participants and len(seen) < num_possible):
+            add_rows(rng.integers(0, num_permutations, size=(num_participants - filled, num_sequences)))
+
+    if (filled < num_participants):
+        print('WARNING:: Only ({0}) unique block orders exist for ({1}) participants'.format(filled, num_participants))
+        # Reuse the unique orders for the remaining participants
+        block_orders[filled:] = block_orders[np.arange(num_participants - filled) % max(filled, 1)]
+
+    return block_orders
@@ -0,0 +1,139 @@
+# erp_epochs.py
+#
+# Cuts epochs around the event codes of a recording and averages them
+# into ERP waveforms. Recordings are read through the binary cache in
+# recording_io, so epochs are views into the memory mapped channels
+
+import argparse
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+import recording_io
+
+# Number of leading samples the sample rate is estimated from
+SAMPLE_RATE_SAMPLES = 100000
+
+class Epochs:
+    """
+    Event-locked epochs of a (samples, channels) matrix.
+    Epochs are never copied: each one is a view into a sliding window over
+    the channels, selected by its start sample. Indexing with an int gives a
+    (samples, channels) view, array() copies all epochs into one array
+    """
+    def __init__(self, channels, starts, num_samples):
+        self.channels = channels
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.num_samples = num_samples
+        if (self.starts.size == 0):
+            # sliding_window_view rejects windows that are empty or longer
+            # than the recording, and there is no epoch to view anyway
+            self.windows = np.empty((0, num_samples, channels.shape[1]), dtype=channels.dtype)
+        else:
+            # windows[i] is the (samples, channels) epoch starting at sample i
+            self.windows = np.swapaxes(sliding_window_view(channels, num_samples, axis=0), 1, 2)
+
+    @property
+    def shape(self):
+        return (self.starts.size, self.num_samples, self.channels.shape[1])
+
+    def __len__(self):
+        return self.starts.size
+
+    def __getitem__(self, index):
+        return self.windows[self.starts[index]]
+
+    def __iter__(self):
+        for start in self.starts:
+            yield self.windows[start]
+
+    def array(self):
+        """
+        Returns a copy of every epoch as one (events, samples, channels) array
+        """
+        return self.windows[self.starts]
+
+    def mean(self):
+        """
+        Returns the average epoch as a (samples, channels) float64 array.
+        Sums one sample offset of every epoch at a time, so only
+        (events, channels) values are gathered at once
+        """
+        total = np.zeros((self.num_samples, self.channels.shape[1]), dtype=np.float64)
+        if (self.starts.size == 0):
+            return total
+        for offset in range(self.num_samples):
+            total[offset] = self.channels[self.starts + offset].sum(axis=0, dtype=np.float64)
+        return total / self.starts.size
+
+def find_event_onsets(events, codes=None):
+    """
+    Returns the sample indices where an event code starts (see
+    recording_io.find_event_onsets). If codes is given only those codes
+    are returned
+    """
+    events = np.asarray(events)
+    onsets = recording_io.find_event_onsets(events)
+    if (codes is not None):
+        onsets = onsets[np.isin(events[onsets], codes)]
+    return onsets
+
+def get_epochs(channels, onsets, pre_samples, post_samples):
+    """
+    Returns the Epochs from pre_samples before to post_samples after each
+    onset. Onsets whose epoch would run past either end of the recording
+    are dropped, so the Epochs are empty if the epochs are longer than
+    the recording or hold no samples
+    """
+    starts = np.asarray(onsets, dtype=np.int64) - pre_samples
+    num_samples = max(pre_samples + post_samples, 0)
+    starts = starts[(starts >= 0) & (starts + num_samples <= channels.shape[0]) & (num_samples > 0)]
+    return Epochs(channels, starts, num_samples)
+
+def average_by_code(recording, pre_samples, post_samples, codes=None):
+    """
+    Returns a dictionary mapping each event code of a recording to
+    (average epoch, number of epochs averaged)
+    """
+    events = np.asarray(recording.events)
+    onsets = find_event_onsets(events, codes)
+    averages = {}
+    for event_code in np.unique(events[onsets]):
+        epochs = get_epochs(recording.channels, onsets[events[onsets] == event_code], pre_samples, post_samples)
+        averages[int(event_code)] = (epochs.mean(), len(epochs))
+    return averages
+
+def average_targets(recording, pre_samples, post_samples):
+    """
+    Returns (non-target average, target average) epochs of a recording,
+    using the same event code thresholds as
+    verify_subject_file.verify_data_file (1-3 non-target, above 3 target)
+    """
+    events = np.asarray(recording.events)
+    onsets = find_event_onsets(events)
+    nontarget = get_epochs(recording.channels, onsets[events[onsets] <= 3], pre_samples, post_samples)
+    target = get_epochs(recording.channels, onsets[events[onsets] > 3], pre_samples, post_samples)
+    return nontarget.mean(), target.mean()
+
+def estimate_sample_rate(times):
+    """
+    Returns the sample rate of a recording from the median time step of
+    its first SAMPLE_RATE_SAMPLES samples
+    """
+    if (len(times) < 2):
+        return 0.0
+    return 1.0 / float(np.median(np.diff(times[:SAMPLE_RATE_SAMPLES])))
+
+if (__name__ == '__main__'):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', help='Path to a Subject_N_Data.csv recording', type=str)
+    parser.add_argument('out', help='Path of the .npz file to save the averages to', type=str)
+    parser.add_argument('--pre', help='Number of samples before each event', type=int, default=0)
+    parser.add_argument('--post', help='Number of samples after each event', type=int, default=256)
+    args = parser.parse_args()
+
+    recording = recording_io.load_recording(args.path)
+    averages = average_by_code(recording, args.pre, args.post)
+    for event_code, (_, count) in averages.items():
+        print('Event code ({0}): {1} epochs'.format(event_code, count))
+
+    np.savez(args.out, sample_rate=estimate_sample_rate(recording.times),
+        **{ 'code_{0}'.format(event_code): average for event_code, (average, _) in averages.items() })
@@ -0,0 +1,184 @@
+# filter_recording.py
+#
+# Band-pass filters and downsamples a Subject_N_Data.csv recording
+# before ERP analysis. The recording is streamed in chunks and the
+# filter state is carried from one chunk to the next, so the output is
+# the same as filtering the whole file at once while memory use does not
+# depend on the length of the recording
+
+import argparse
+import numpy as np
+from scipy import signal
+import recording_io
+from erp_epochs import SAMPLE_RATE_SAMPLES, estimate_sample_rate
+
+
+class StreamingFilter:
+    """
+    Applies a second-order sections IIR filter to consecutive chunks of
+    (samples, channels) data, keeping the filter state between chunks
+    """
+    def __init__(self, sos, num_channels):
+        self.sos = sos
+        self.state = np.zeros((sos.shape[0], 2, num_channels))
+
+    def process(self, samples):
+        filtered, self.state = signal.sosfilt(self.sos, samples, axis=0, zi=self.state)
+        return filtered
+
+class Decimator:
+    """
+    Keeps every factor'th sample of consecutive chunks of samples.
+    Each kept sample takes the last non-zero event code of the samples
+    after the previous kept sample up to and including itself, so an event
+    is moved to the first kept sample at or after its onset and no event
+    is lost when downsampling
+    """
+    def __init__(self, factor):
+        self.factor = factor
+        self.carry_rows = None
+        self.carry_events = None
+        # Last non-zero event code after the last kept sample
+        self.pending_event = 0
+        self.last_row = None
+
+    def process(self, rows, events):
+        if (self.carry_rows is not None):
+            rows = np.concatenate((self.carry_rows, rows), axis=0)
+            events = np.concatenate((self.carry_events, events))
+        if (rows.shape[0] > 0):
+            self.last_row = rows[-1]
+
+        # Only whole groups of factor samples are output, the rest is
+        # carried into the next chunk
+        num_kept = rows.shape[0] // self.factor
+        split = num_kept * self.factor
+        self.carry_rows = rows[split:]
+        self.carry_events = events[split:]
+        return self.combine(rows[:split], events[:split])
+
+    def flush(self):
+        """
+        Returns the first sample of the last partial group, and the last
+        sample of the recording if an event started after the last kept
+        sample
+        """
+        if (self.carry_rows is not None and self.carry_rows.shape[0] > 0):
+            rows, events = self.carry_rows, self.carry_events
+            # Pad the partial group so it can be combined like the others
+            padding = self.factor - rows.shape[0]
+            rows = np.concatenate((rows, np.repeat(rows[-1:], padding, axis=0)), axis=0)
+            events = np.concatenate((events, np.zeros(padding, dtype=events.dtype)))
+            rows, kept_events = self.combine(rows, events)
+        else:
+            rows = np.zeros((0, 0 if self.last_row is None else self.last_row.size))
+            kept_events = np.zeros(0)
+        self.carry_rows = None
+        self.carry_events = None
+
+        if (self.pending_event != 0):
+            rows = np.concatenate((rows, self.last_row[np.newaxis, :]), axis=0)
+            kept_events = np.append(kept_events, self.pending_event)
+            self.pending_event = 0
+        if (rows.shape[0] == 0):
+            return None, None
+        return rows, kept_events
+
+    def combine(self, rows, events):
+        if (self.factor == 1 or rows.shape[0] == 0):
+            return rows, events
+        groups = events.reshape(-1, self.factor)
+        # Last non-zero code of the samples after each kept sample (0 if there is none)
+        tails = groups[:, 1:]
+        last = tails.shape[1] - 1 - np.argmax(tails[:, ::-1] != 0, axis=1)
+        tail_events = np.where(np.any(tails != 0, axis=1), tails[np.arange(groups.shape[0]), last], 0)
+        # A kept sample takes its own code, or else the last code since the previous kept sample
+        previous_tails = np.concatenate(([self.pending_event], tail_events[:-1]))
+        group_events = np.where(groups[:, 0] != 0, groups[:, 0], previous_tails)
+        self.pending_event = tail_events[-1]
+        return rows[::self.factor], group_events
+
+def design_bandpass(low, high, sample_rate, order=4):
+    """
+    Returns the second-order sections of a Butterworth band-pass filter
+    """
+    return signal.butter(order, [low, high], btype='bandpass', fs=sample_rate, output='sos')
+
+def parse_samples(lines):
+    """
+    Returns (times, events, channels) of a list of sample lines
+    """
+    samples = np.loadtxt(lines, delimiter=',', ndmin=2)
+    return (samples[:, recording_io.TIME_COLUMN], samples[:, recording_io.EVENT_COLUMN],
+        samples[:, recording_io.FIRST_CHANNEL_COLUMN:])
+
+def read_sample_times(path, num_samples, chunk_size=recording_io.DEFAULT_CHUNK_SIZE):
+    """
+    Returns the times of the first num_samples samples of a recording.
+    Only the time column is split out of each line
+    """
+    times = []
+    for lines in recording_io.iter_line_chunks(path, chunk_size):
+        times.extend(float(line.split(b',', 1)[recording_io.TIME_COLUMN]) for line in lines[:num_samples - len(times)])
+        if (len(times) >= num_samples):
+            break
+    return np.array(times)
+
+def write_samples(fp, times, events, channels):
+    """
+    Appends samples to an open recording file in the format of
+    SimpleDataManager.ExportData
+    """
+    if (times.size > 0):
+        np.savetxt(fp, np.column_stack((times, events, channels)), fmt='%.17g', delimiter=',')
+
+def filter_recording(path, out_path, low, high, factor=1, order=4, sample_rate=None, chunk_size=recording_io.DEFAULT_CHUNK_SIZE):
+    """
+    Band-pass filters the channels of a recording, keeps every factor'th
+    sample and writes the result to out_path chunk by chunk.
+    If the sample rate is not given it is estimated from the first
+    SAMPLE_RATE_SAMPLES samples, whatever the chunk size.
+    Returns the number of samples written
+    """
+    if (sample_rate is None):
+        sample_rate = estimate_sample_rate(read_sample_times(path, SAMPLE_RATE_SAMPLES, chunk_size))
+    bandpass = None
+    decimator = Decimator(factor)
+    num_written = 0
+
+    with open(out_path, 'wb') as fp:
+        for lines in recording_io.iter_line_chunks(path, chunk_size):
+            if (len(lines) == 0):
+                continue
+            times, events, channels = parse_samples(lines)
+
+            if (bandpass is None):
+                if (high >= sample_rate / (2 * factor)):
+                    print('WARNING:: High cutoff ({0} Hz) is above the Nyquist frequency after decimation ({1} Hz)'.format(high, sample_rate / (2 * factor)))
+                bandpass = StreamingFilter(design_bandpass(low, high, sample_rate, order), channels.shape[1])
+
+            rows, kept_events = decimator.process(np.column_stack((times, bandpass.process(channels))), events)
+            write_samples(fp, rows[:, 0], kept_events, rows[:, 1:])
+            num_written += rows.shape[0]
+
+        rows, kept_events = decimator.flush()
+        if (rows is not None):
+            write_samples(fp, rows[:, 0], kept_events, rows[:, 1:])
+            num_written += rows.shape[0]
+
+    return num_written
+
+if (__name__ == '__main__'):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', help='Path to a Subject_N_Data.csv recording', type=str)
+    parser.add_argument('out_path', help='Path to write the filtered recording to', type=str)
+    parser.add_argument('--low', help='Low cutoff of the band-pass (Hz)', type=float, default=0.5)
+    parser.add_argument('--high', help='High cutoff of the band-pass (Hz)', type=float, default=30.0)
+    parser.add_argument('--order', help='Order of the Butterworth filter', type=int, default=4)
+    parser.add_argument('--decimate', help='Keep every n\'th sample', type=int, default=1)
+    parser.add_argument('--sample_rate', help='Sample rate of the recording (estimated from its first samples if not given)', type=float, default=None)
+    parser.add_argument('--chunk_size', help='Number of bytes read at a time', type=int, default=recording_io.DEFAULT_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    num_samples = filter_recording(args.path, args.out_path, args.low, args.high, args.decimate, args.order, args.sample_rate, args.chunk_size)
+    print('Wrote ({0}) samples to {1}'.format(num_samples, args.out_path))
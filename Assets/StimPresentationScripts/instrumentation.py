@@ -0,0 +1,161 @@
+# instrumentation.py
+#
+# Counters, stage timings and events reported by the presentation order
+# generator. Nothing is recorded unless an Instrumentation is installed
+# with set_instrumentation, and callers check `enabled` before building
+# event fields, so disabled instrumentation costs one attribute lookup
+
+import contextlib
+import json
+import sys
+import time
+
+
+class Instrumentation:
+    """
+    Aggregates counters and per-stage timings and passes every event to
+    a list of hooks. A hook is any callable taking (name, fields)
+    """
+    enabled = True
+
+    def __init__(self, hooks=None):
+        self.hooks = list(hooks or [])
+        self.counters = {}
+        self.timings = {}
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def event(self, name, **fields):
+        for hook in self.hooks:
+            hook(name, fields)
+
+    def warning(self, name, message, **fields):
+        """
+        Counts and reports something unexpected that the generator recovered from
+        """
+        self.count(name)
+        self.event(name, level='warning', message=message, **fields)
+
+    def error(self, name, message, **fields):
+        """
+        Counts and reports a result that does not match the design
+        """
+        self.count(name)
+        self.event(name, level='error', message=message, **fields)
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """
+        Times a block of code and adds it to the total of the stage
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            total, calls = self.timings.get(stage, (0.0, 0))
+            self.timings[stage] = (total + elapsed, calls + 1)
+            self.event('stage', stage=stage, seconds=elapsed)
+
+    def merge(self, summary):
+        """
+        Adds the counters and timings of another instrumentation's summary
+        (e.g. one sent back by a worker process)
+        """
+        for name, amount in summary['counters'].items():
+            self.count(name, amount)
+        for stage, timing in summary['timings'].items():
+            total, calls = self.timings.get(stage, (0.0, 0))
+            self.timings[stage] = (total + timing['seconds'], calls + timing['calls'])
+
+    def summary(self):
+        """
+        Returns the aggregated counters and timings as a JSON-able dictionary
+        """
+        return { 'counters': dict(self.counters),
+            'timings': { stage: { 'seconds': total, 'calls': calls } for stage, (total, calls) in self.timings.items() } }
+
+class NullInstrumentation:
+    """
+    Installed when instrumentation is disabled. Records nothing, but still
+    prints warnings and errors like the generator always has
+    """
+    enabled = False
+
+    def add_hook(self, hook):
+        pass
+
+    def count(self, name, amount=1):
+        pass
+
+    def event(self, name, **fields):
+        pass
+
+    def warning(self, name, message, **fields):
+        print('WARNING:: {0}'.format(message))
+
+    def error(self, name, message, **fields):
+        print('ERROR:: {0}'.format(message))
+
+    def timer(self, stage):
+        return NULL_TIMER
+
+    def merge(self, summary):
+        pass
+
+    def summary(self):
+        return { 'counters': {}, 'timings': {} }
+
+class JsonEventStream:
+    """
+    Hook that writes every event as one line of JSON
+    """
+    def __init__(self, fp):
+        self.fp = fp
+
+    def __call__(self, name, fields):
+        self.fp.write(json.dumps(dict(fields, event=name), default=str))
+        self.fp.write('\n')
+
+class PrintHook:
+    """
+    Hook that prints every event as readable text (the --verbose output)
+    """
+    def __init__(self, fp=None):
+        self.fp = fp
+
+    def __call__(self, name, fields):
+        details = ', '.join('{0}={1}'.format(key, value) for key, value in fields.items())
+        print('{0}:: {1}'.format(name, details), file=self.fp or sys.stdout)
+
+NULL_TIMER = contextlib.nullcontext()
+NULL_INSTRUMENTATION = NullInstrumentation()
+active_instrumentation = NULL_INSTRUMENTATION
+verbose_instrumentation = None
+
+
+def set_instrumentation(instrumentation):
+    """
+    Installs the instrumentation used by the generator. Passing None
+    disables it. Returns the previously installed instrumentation
+    """
+    global active_instrumentation
+    previous = active_instrumentation
+    active_instrumentation = instrumentation or NULL_INSTRUMENTATION
+    return previous
+
+def get_instrumentation(verbose=False):
+    """
+    Returns the installed instrumentation. When nothing is installed and
+    verbose is true, returns one that prints every event instead
+    """
+    global verbose_instrumentation
+    if (verbose and not active_instrumentation.enabled):
+        if (verbose_instrumentation is None):
+            verbose_instrumentation = Instrumentation([PrintHook()])
+        return verbose_instrumentation
+    return active_instrumentation
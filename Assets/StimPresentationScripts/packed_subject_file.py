@@ -0,0 +1,130 @@
+# packed_subject_file.py
+#
+# Compact binary alternative to the SUBJECT_N.json files written by
+# stim_presentation.export_subjectfile. A packed file is a fixed size
+# header followed by the targets of every block and then every trial as a
+# contiguous int8 buffer, which can be memory mapped instead of decoded
+
+import argparse
+import json
+import os
+import struct
+import numpy as np
+
+PACKED_EXTENSION = '.bin'
+PACKED_MAGIC = b'ERPS'
+PACKED_VERSION = 1
+# magic, version, reserved, num_sequences, blocks_per_sequence, num_stimuli,
+# trials_per_block, target_trial_percentage
+HEADER_FORMAT = '<4sHHIIIId'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+
+class PackedSubject:
+    """
+    A packed subject file opened for reading. targets is a
+    (sequences, blocks) array and blocks a read-only memory mapped
+    (sequences, blocks, trials) array, so blocks are views into the file
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as fp:
+            header = fp.read(HEADER_SIZE)
+        if (len(header) < HEADER_SIZE):
+            raise ValueError('{0} is too short to be a packed subject file'.format(path))
+        magic, version, _, num_sequences, blocks_per_sequence, num_stimuli, trials_per_block, target_trial_percentage = struct.unpack(HEADER_FORMAT, header)
+        if (magic != PACKED_MAGIC or version != PACKED_VERSION):
+            raise ValueError('{0} is not a version {1} packed subject file'.format(path, PACKED_VERSION))
+
+        self.path = path
+        self.num_sequences = num_sequences
+        self.blocks_per_sequence = blocks_per_sequence
+        self.num_stimuli = num_stimuli
+        self.trials_per_block = trials_per_block
+        self.target_trial_percentage = target_trial_percentage
+
+        num_blocks = num_sequences * blocks_per_sequence
+        self.targets = np.memmap(path, dtype=np.int8, mode='r', offset=HEADER_SIZE,
+            shape=(num_sequences, blocks_per_sequence)) if num_blocks else np.zeros((num_sequences, blocks_per_sequence), dtype=np.int8)
+        self.blocks = np.memmap(path, dtype=np.int8, mode='r', offset=HEADER_SIZE + num_blocks,
+            shape=(num_sequences, blocks_per_sequence, trials_per_block)) if num_blocks * trials_per_block else np.zeros((num_sequences, blocks_per_sequence, trials_per_block), dtype=np.int8)
+
+    def get_block(self, sequence, block):
+        """
+        Returns the trials of a block as a view into the file
+        """
+        return self.blocks[sequence, block]
+
+    def to_dict(self):
+        """
+        Returns the participant dictionary written to SUBJECT_N.json files
+        """
+        participant = { 'num_sequences': self.num_sequences, 'blocks_per_sequence': self.blocks_per_sequence, 'num_stimuli': self.num_stimuli,
+        'trials_per_block': self.trials_per_block, 'target_trial_percentage': self.target_trial_percentage, 'sequences' : [] }
+        for s in range(self.num_sequences):
+            participant['sequences'].append({ 'targets': self.targets[s].tolist(), 'blocks': self.blocks[s].tolist() })
+        return participant
+
+def write_packed_subject(path, blocks, targets, target_trial_percentage, num_stimuli=None):
+    """
+    Writes a (sequences, blocks, trials) trial array and its
+    (sequences, blocks) targets to a packed subject file
+    """
+    blocks = np.ascontiguousarray(blocks, dtype=np.int8)
+    targets = np.ascontiguousarray(targets, dtype=np.int8)
+    num_sequences, blocks_per_sequence, trials_per_block = blocks.shape
+    if (num_stimuli is None):
+        num_stimuli = blocks_per_sequence
+
+    header = struct.pack(HEADER_FORMAT, PACKED_MAGIC, PACKED_VERSION, 0, num_sequences, blocks_per_sequence,
+        num_stimuli, trials_per_block, target_trial_percentage)
+    with open(path, 'wb') as fp:
+        fp.write(header)
+        fp.write(targets.tobytes())
+        fp.write(blocks.tobytes())
+
+def read_packed_subject(path):
+    """
+    Opens a packed subject file
+    """
+    return PackedSubject(path)
+
+def json_to_packed(json_path, packed_path=None):
+    """
+    Converts a SUBJECT_N.json file to a packed subject file.
+    Returns the path of the packed file
+    """
+    if (packed_path is None):
+        packed_path = os.path.splitext(json_path)[0] + PACKED_EXTENSION
+    with open(json_path, 'r') as fp:
+        participant = json.load(fp)
+
+    num_sequences = participant['num_sequences']
+    blocks_per_sequence = participant['blocks_per_sequence']
+    blocks = np.array([sequence['blocks'] for sequence in participant['sequences']], dtype=np.int8)
+    targets = np.array([sequence['targets'] for sequence in participant['sequences']], dtype=np.int8)
+    write_packed_subject(packed_path, blocks.reshape(num_sequences, blocks_per_sequence, participant['trials_per_block']),
+        targets.reshape(num_sequences, blocks_per_sequence), participant['target_trial_percentage'], participant['num_stimuli'])
+    return packed_path
+
+def packed_to_json(packed_path, json_path=None):
+    """
+    Converts a packed subject file back to a SUBJECT_N.json file.
+    Returns the path of the json file
+    """
+    if (json_path is None):
+        json_path = os.path.splitext(packed_path)[0] + '.json'
+    participant = read_packed_subject(packed_path).to_dict()
+    with open(json_path, 'w') as fp:
+        json.dump(participant, fp)
+    return json_path
+
+if (__name__ == '__main__'):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('paths', help='Subject files to convert (.json files are packed, {0} files are unpacked)'.format(PACKED_EXTENSION), type=str, nargs='+')
+    args = parser.parse_args()
+
+    for path in args.paths:
+        if (path.endswith(PACKED_EXTENSION)):
+            print('Wrote {0}'.format(packed_to_json(path)))
+        else:
+            print('Wrote {0}'.format(json_to_packed(path)))
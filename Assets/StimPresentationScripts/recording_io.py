@@ -0,0 +1,353 @@
+# recording_io.py
+#
+# Reads the Subject_N_Data.csv recordings written by
+# SimpleDataManager.ExportData. Every row is one sample:
+# [time, event code, channel 1, ..., channel n]
+
+import argparse
+import json
+import os
+import numpy as np
+
+TIME_COLUMN = 0
+EVENT_COLUMN = 1
+FIRST_CHANNEL_COLUMN = 2
+
+# Number of bytes read from a recording at a time
+DEFAULT_CHUNK_SIZE = 1 << 22
+
+# Version of the binary cache layout, caches of other versions are rebuilt
+CACHE_VERSION = 1
+CACHE_HEADER = 'header.json'
+# Number of times a cache is rebuilt when the recording changes while it is read
+CACHE_BUILD_ATTEMPTS = 3
+
+
+def iter_line_chunks(path, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yields lists of complete lines (as bytes) read from a recording,
+    about chunk_size bytes at a time
+    """
+    with open(path, 'rb') as fp:
+        while True:
+            lines = fp.readlines(chunk_size)
+            if (not lines):
+                break
+            yield [line for line in lines if line.strip()]
+
+class RecordingTail:
+    """
+    Reads the lines appended to a recording since the last read, starting
+    from a byte offset. Only complete lines are returned, a line that is
+    still being written is read once its newline is there. If the file
+    shrinks (e.g. a new session overwrote it) reading starts over and
+    restarted is set
+    """
+    def __init__(self, path, offset=0):
+        self.path = path
+        self.offset = offset
+        self.restarted = False
+
+    def read_lines(self, max_bytes=DEFAULT_CHUNK_SIZE):
+        """
+        Returns up to about max_bytes of new complete lines (as bytes)
+        """
+        self.restarted = False
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return []
+        if (size < self.offset):
+            self.offset = 0
+            self.restarted = True
+        if (size == self.offset):
+            return []
+
+        with open(self.path, 'rb') as fp:
+            fp.seek(self.offset)
+            data = fp.read(max_bytes)
+        end = data.rfind(b'\n')
+        if (end < 0):
+            return []
+        self.offset += end + 1
+        return [line for line in data[:end + 1].splitlines() if line.strip()]
+
+def parse_event_column(lines):
+    """
+    Returns the event codes of a list of sample lines as an int array.
+    Only the event column is split out of each line
+    """
+    if (len(lines) == 0):
+        return np.zeros(0, dtype=np.int64)
+    return np.array([line.split(b',', 2)[EVENT_COLUMN] for line in lines]).astype(float).astype(np.int64)
+
+def iter_event_chunks(path, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yields the event codes of a recording one chunk at a time
+    """
+    for lines in iter_line_chunks(path, chunk_size):
+        yield parse_event_column(lines)
+
+def accumulate_event_counts(counts, event_codes):
+    """
+    Adds the number of times each positive event code appears to an array
+    of counts indexed by event code. Returns the (possibly grown) counts
+    """
+    event_codes = event_codes[event_codes > 0]
+    chunk_counts = np.bincount(event_codes, minlength=counts.size)
+    chunk_counts[:counts.size] += counts
+    return chunk_counts
+
+def find_event_onsets(event_codes, previous_code=0):
+    """
+    Returns the indices of the event onsets in a chunk of event codes. A
+    sample is an onset if its code is not 0 and differs from the code of
+    the sample before it, which is previous_code for the first sample of
+    the chunk (the last code of the previous chunk, 0 at the start)
+    """
+    event_codes = np.asarray(event_codes)
+    onsets = (event_codes != 0)
+    if (event_codes.size > 0):
+        onsets[0] &= (event_codes[0] != previous_code)
+        onsets[1:] &= (event_codes[1:] != event_codes[:-1])
+    return np.flatnonzero(onsets)
+
+class EventCounter:
+    """
+    Counts the samples and event onsets of each event code of a recording
+    fed to it one chunk of event codes at a time. Onsets are found across
+    chunk boundaries, so the counts do not depend on how the recording
+    was split into chunks
+    """
+    def __init__(self):
+        self.num_samples = 0
+        self.sample_counts = np.zeros(0, dtype=np.int64)
+        self.onset_counts = np.zeros(0, dtype=np.int64)
+        self.previous_code = 0
+
+    def update(self, event_codes):
+        """
+        Adds the next chunk of event codes. Returns the indices of its
+        onsets within the chunk
+        """
+        onsets = find_event_onsets(event_codes, self.previous_code)
+        if (event_codes.size == 0):
+            return onsets
+        self.sample_counts = accumulate_event_counts(self.sample_counts, event_codes)
+        self.onset_counts = accumulate_event_counts(self.onset_counts, event_codes[onsets])
+        self.previous_code = event_codes[-1]
+        self.num_samples += event_codes.size
+        return onsets
+
+    def to_dict(self):
+        return { 'num_samples': self.num_samples, 'sample_counts': self.sample_counts.tolist(), 'onset_counts': self.onset_counts.tolist() }
+
+def count_events(path, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Streams a recording and returns the EventCounter of all its samples.
+    Memory use only depends on chunk_size, not on the length of the recording
+    """
+    counter = EventCounter()
+    for event_codes in iter_event_chunks(path, chunk_size):
+        counter.update(event_codes)
+    return counter
+
+def count_event_codes(path, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Streams a recording and returns (counts, num_samples) where counts[code]
+    is the number of samples marked with each event code
+    """
+    counter = count_events(path, chunk_size)
+    return counter.sample_counts, counter.num_samples
+
+def read_event_onsets(path, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Streams a recording and returns (samples, codes): the sample index and
+    event code of every event onset (see find_event_onsets)
+    """
+    samples = []
+    codes = []
+    counter = EventCounter()
+    for event_codes in iter_event_chunks(path, chunk_size):
+        start = counter.num_samples
+        onsets = counter.update(event_codes)
+        samples.append(onsets + start)
+        codes.append(event_codes[onsets])
+    if (len(samples) == 0):
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(samples), np.concatenate(codes)
+
+def split_event_counts(counts):
+    """
+    Splits an array of counts indexed by event code into the non-target
+    (codes 1-3) and target (codes above 3) dictionaries printed by
+    verify_subject_file.verify_data_file
+    """
+    target = {}
+    nontarget = {}
+    for event_code in np.flatnonzero(counts):
+        if (event_code > 3):
+            target[str(event_code)] = int(counts[event_code])
+        elif (event_code > 0):
+            nontarget[str(event_code)] = int(counts[event_code])
+    return nontarget, target
+
+class Recording:
+    """
+    A recording opened from its binary cache.
+    times, events and channels are read-only memory maps, so slicing a
+    column or a range of samples does not copy or read the whole file
+    """
+    def __init__(self, cache_dir, header):
+        self.cache_dir = cache_dir
+        self.header = header
+        self.times = np.load(os.path.join(cache_dir, 'times.npy'), mmap_mode='r')
+        self.events = np.load(os.path.join(cache_dir, 'events.npy'), mmap_mode='r')
+        self.channels = np.load(os.path.join(cache_dir, 'channels.npy'), mmap_mode='r')
+
+    @property
+    def num_samples(self):
+        return self.header['num_samples']
+
+    @property
+    def num_channels(self):
+        return self.header['num_channels']
+
+    def __str__(self):
+        return 'Recording: {0} [{1} samples, {2} channels]'.format(self.header['source'], self.num_samples, self.num_channels)
+
+def get_cache_dir(path):
+    """
+    Returns the directory that holds the binary cache of a recording,
+    e.g. Subject_0_Data.csv => Subject_0_Data.cache
+    """
+    return '{0}.cache'.format(os.path.splitext(path)[0])
+
+def get_source_signature(path):
+    """
+    Returns the size and modification time of a recording. The cache is
+    rebuilt whenever these change
+    """
+    stat = os.stat(path)
+    return { 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns }
+
+def read_cache_header(cache_dir):
+    """
+    Returns the header of a cache or None if it does not exist
+    """
+    try:
+        with open(os.path.join(cache_dir, CACHE_HEADER), 'r') as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+def cache_is_valid(path, cache_dir=None):
+    """
+    Returns true if the cache of a recording was built from the current
+    version of the recording
+    """
+    header = read_cache_header(cache_dir or get_cache_dir(path))
+    return (header is not None and header.get('version') == CACHE_VERSION
+        and header.get('signature') == get_source_signature(path))
+
+def write_cache_arrays(path, cache_dir, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Parses a recording into the .npy files of its cache.
+    The first pass counts the samples, the second fills the memory mapped
+    arrays and stops at that count, so samples appended in between are
+    left out rather than overflowing the arrays.
+    Returns (num_samples, num_channels, samples parsed in the second pass)
+    """
+    # First pass finds the size of the arrays
+    num_samples = 0
+    num_columns = None
+    for lines in iter_line_chunks(path, chunk_size):
+        if (num_columns is None and len(lines) > 0):
+            num_columns = lines[0].count(b',') + 1
+        num_samples += len(lines)
+    if (num_columns is None):
+        num_columns = FIRST_CHANNEL_COLUMN
+    num_channels = num_columns - FIRST_CHANNEL_COLUMN
+
+    open_memmap = np.lib.format.open_memmap
+    times = open_memmap(os.path.join(cache_dir, 'times.npy'), mode='w+', dtype=np.float64, shape=(num_samples,))
+    events = open_memmap(os.path.join(cache_dir, 'events.npy'), mode='w+', dtype=np.int32, shape=(num_samples,))
+    channels = open_memmap(os.path.join(cache_dir, 'channels.npy'), mode='w+', dtype=np.float32, shape=(num_samples, num_channels))
+
+    # Second pass parses the samples into the arrays
+    start = 0
+    for lines in iter_line_chunks(path, chunk_size):
+        lines = lines[:num_samples - start]
+        if (len(lines) == 0):
+            if (start == num_samples):
+                break
+            continue
+        samples = np.loadtxt(lines, delimiter=',', ndmin=2)
+        stop = start + samples.shape[0]
+        times[start:stop] = samples[:, TIME_COLUMN]
+        events[start:stop] = samples[:, EVENT_COLUMN]
+        channels[start:stop] = samples[:, FIRST_CHANNEL_COLUMN:]
+        start = stop
+
+    for array in (times, events, channels):
+        array.flush()
+    del times, events, channels
+    return num_samples, num_channels, start
+
+def build_cache(path, cache_dir=None, chunk_size=DEFAULT_CHUNK_SIZE, max_attempts=CACHE_BUILD_ATTEMPTS):
+    """
+    Converts a recording to its binary cache: times (float64), event codes
+    (int32) and a (samples, channels) float32 channel matrix stored as .npy
+    files, plus a small json header.
+    The recording is parsed chunk_size bytes at a time and written straight
+    into the memory mapped output. The header is written last, so an
+    interrupted conversion is never mistaken for a valid cache. If the
+    recording changes while it is parsed (e.g. the game is still writing
+    it) the arrays are thrown away and built again, up to max_attempts times.
+    Returns the cache directory
+    """
+    if (cache_dir is None):
+        cache_dir = get_cache_dir(path)
+    os.makedirs(cache_dir, exist_ok=True)
+    header_path = os.path.join(cache_dir, CACHE_HEADER)
+    if (os.path.exists(header_path)):
+        os.remove(header_path)
+
+    for attempt in range(max_attempts):
+        signature = get_source_signature(path)
+        num_samples, num_channels, num_parsed = write_cache_arrays(path, cache_dir, chunk_size)
+        if (num_parsed == num_samples and get_source_signature(path) == signature):
+            break
+    else:
+        raise ValueError('{0} kept changing while its cache was built, build it once the recording is complete'.format(path))
+
+    header = { 'version': CACHE_VERSION, 'source': os.path.basename(path), 'signature': signature,
+        'num_samples': num_samples, 'num_channels': num_channels }
+    temp_path = header_path + '.tmp'
+    with open(temp_path, 'w') as fp:
+        json.dump(header, fp)
+    os.replace(temp_path, header_path)
+    return cache_dir
+
+def load_recording(path, cache_dir=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Opens a recording through its binary cache, building the cache first
+    if it is missing or the recording has changed since it was built
+    """
+    if (cache_dir is None):
+        cache_dir = get_cache_dir(path)
+    if (not cache_is_valid(path, cache_dir)):
+        build_cache(path, cache_dir, chunk_size)
+    return Recording(cache_dir, read_cache_header(cache_dir))
+
+if (__name__ == '__main__'):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('paths', help='Recordings to convert to binary caches', type=str, nargs='+')
+    parser.add_argument('--force', help='Rebuild caches even if they are up to date', action='store_true', default=False)
+    args = parser.parse_args()
+
+    for path in args.paths:
+        if (args.force or not cache_is_valid(path)):
+            print('Building cache: {0}'.format(build_cache(path)))
+        else:
+            print('Cache up to date: {0}'.format(get_cache_dir(path)))
@@ -0,0 +1,147 @@
+# self_checks.py
+#
+# Small checks of the parts of the generator and the verifier that are
+# easy to get subtly wrong. Each check compares a fast implementation with
+# a slow, obviously correct one on a case small enough to enumerate or
+# with a known answer.
+# Run with `python self_checks.py`; exits with 1 if any check fails
+
+import itertools
+import math
+import sys
+import numpy as np
+import stim_presentation
+import verify_subject_file
+
+
+def get_separations(block, target_index):
+    """
+    Returns the number of trials between consecutive targets of a block
+    """
+    return np.diff(np.flatnonzero(np.asarray(block) == target_index)) - 1
+
+def enumerate_constrained_blocks(units, target_index, min_target_separation=0, max_target_separation=math.inf):
+    """
+    Returns every distinct block that can be made from the units of
+    generate_block_units while respecting the separation limits, by trying
+    every ordering of the units
+    """
+    blocks = set()
+    for order in set(itertools.permutations(map(tuple, units.tolist()))):
+        block = tuple(stim for unit in order for stim in unit if stim >= 0)
+        separations = get_separations(block, target_index)
+        if (np.all(separations >= min_target_separation) and np.all(separations <= max_target_separation)):
+            blocks.add(block)
+    return blocks
+
+def check_constrained_sampler(num_trials=9, num_target_trials=3, target_index=0, num_stimuli=3, draws_per_block=200, seed=0):
+    """
+    Compares count_constrained_blocks with the enumerated blocks and checks
+    that sample_constrained_blocks only draws those blocks, every one of
+    them about equally often
+    """
+    units = stim_presentation.get_block_units(num_trials, num_target_trials, target_index, num_stimuli)
+    rng = np.random.default_rng(seed)
+    failures = []
+    for limits in [(2, math.inf), (0, 2), (2, 4), (0, 3)]:
+        expected = enumerate_constrained_blocks(units, target_index, *limits)
+        count = stim_presentation.count_constrained_blocks(units, *limits)
+        if (count != len(expected)):
+            failures.append('separation {0}: counted ({1}) blocks but there are ({2})'.format(limits, count, len(expected)))
+            continue
+
+        num_draws = draws_per_block * len(expected)
+        drawn = stim_presentation.sample_constrained_blocks(units, num_draws, *limits, rng=rng)
+        frequencies = {}
+        for block in map(tuple, drawn.tolist()):
+            frequencies[block] = frequencies.get(block, 0) + 1
+        invalid = set(frequencies) - expected
+        if (invalid):
+            failures.append('separation {0}: drew ({1}) blocks outside of the limits, e.g. {2}'.format(limits, len(invalid), min(invalid)))
+        elif (len(frequencies) != len(expected)):
+            failures.append('separation {0}: drew ({1}) of the ({2}) blocks'.format(limits, len(frequencies), len(expected)))
+        else:
+            # Every count is binomial around draws_per_block, allow six standard deviations
+            spread = 6 * math.sqrt(draws_per_block)
+            worst = max(abs(frequency - draws_per_block) for frequency in frequencies.values())
+            if (worst > spread):
+                failures.append('separation {0}: a block was drawn {1} times off the expected ({2})'.format(limits, worst, draws_per_block))
+    return failures
+
+def edit_distance(planned, recorded):
+    """
+    Returns the full (unbanded) edit distance between two sequences
+    """
+    previous = list(range(len(recorded) + 1))
+    for i in range(1, len(planned) + 1):
+        row = [i]
+        for j in range(1, len(recorded) + 1):
+            row.append(min(previous[j] + 1, row[j - 1] + 1, previous[j - 1] + (planned[i - 1] != recorded[j - 1])))
+        previous = row
+    return previous[-1]
+
+def apply_differences(planned, recorded, differences):
+    """
+    Rebuilds the recorded sequence from the planned one and the differences
+    of align_event_codes
+    """
+    rebuilt = list(planned)
+    # Going backwards keeps the planned indices of earlier differences valid
+    for operation, planned_index, recorded_index in reversed(differences):
+        if (operation == 'dropped'):
+            del rebuilt[planned_index]
+        elif (operation == 'extra'):
+            rebuilt.insert(planned_index, recorded[recorded_index])
+        else:
+            rebuilt[planned_index] = recorded[recorded_index]
+    return rebuilt
+
+def check_event_alignment(num_trials=200, band=10, seed=0):
+    """
+    Checks that align_event_codes finds dropped, extra and mismatched trials
+    where they were made, and that on random edits its differences are as
+    few as the full edit distance and rebuild the recorded events
+    """
+    rng = np.random.default_rng(seed)
+    planned = rng.integers(1, 8, size=num_trials).tolist()
+    failures = []
+
+    cases = { 'dropped': (planned[:50] + planned[51:], [('dropped', 50, 50)]),
+        'extra': (planned[:50] + [0] + planned[50:], [('extra', 50, 50)]),
+        'mismatch': (planned[:50] + [8] + planned[51:], [('mismatch', 50, 50)]),
+        'identical': (list(planned), []) }
+    for name, (recorded, expected) in cases.items():
+        differences = verify_subject_file.align_event_codes(planned, recorded, band)
+        if (differences != expected):
+            failures.append('{0}: expected {1} but got {2}'.format(name, expected, differences))
+
+    for attempt in range(50):
+        recorded = list(planned)
+        for _ in range(rng.integers(1, 6)):
+            position = int(rng.integers(len(recorded)))
+            operation = rng.integers(3)
+            if (operation == 0):
+                del recorded[position]
+            elif (operation == 1):
+                recorded.insert(position, int(rng.integers(1, 8)))
+            else:
+                recorded[position] = int(rng.integers(1, 8))
+        differences = verify_subject_file.align_event_codes(planned, recorded, band)
+        distance = edit_distance(planned, recorded)
+        if (len(differences) != distance):
+            failures.append('random edits {0}: ({1}) differences but the edit distance is ({2})'.format(attempt, len(differences), distance))
+        elif (apply_differences(planned, recorded, differences) != recorded):
+            failures.append('random edits {0}: the differences do not rebuild the recorded events'.format(attempt))
+    return failures
+
+CHECKS = [check_constrained_sampler, check_event_alignment]
+
+if (__name__ == '__main__'):
+    failed = 0
+    for check in CHECKS:
+        failures = check()
+        print('{0}: {1}'.format(check.__name__, 'FAILED' if failures else 'ok'))
+        for failure in failures:
+            print('  {0}'.format(failure))
+        failed += bool(failures)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,240 @@
+# simulate_design.py
+#
+# Monte Carlo estimates of the statistics of the blocks produced by the
+# presentation order generator: the number of trials between targets,
+# the lengths of runs of the same stimulus and the frequency of every
+# stimulus transition. Blocks are drawn in batches with
+# stim_presentation.generate_design and only histograms and running
+# statistics are kept, so any number of blocks can be simulated
+
+import argparse
+import json
+import math
+import statistics
+import time
+import numpy as np
+import stim_presentation
+
+
+class Histogram:
+    """
+    Counts of non-negative integer values, grown as larger values are added
+    """
+    def __init__(self):
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    def add(self, values):
+        if (values.size == 0):
+            return
+        counts = np.bincount(values)
+        if (counts.size > self.counts.size):
+            self.counts = np.concatenate((self.counts, np.zeros(counts.size - self.counts.size, dtype=np.int64)))
+        self.counts[:counts.size] += counts
+
+    def to_dict(self):
+        return { 'counts': self.counts.tolist(), 'total': int(self.counts.sum()) }
+
+class RunningStatistic:
+    """
+    Mean and variance of a per-block statistic (a scalar or an array for
+    every block), merged batch by batch with Chan's parallel algorithm
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        if (values.shape[0] == 0):
+            return
+        batch_count = values.shape[0]
+        batch_mean = values.mean(axis=0)
+        batch_m2 = ((values - batch_mean) ** 2).sum(axis=0)
+
+        total = self.count + batch_count
+        delta = batch_mean - self.mean
+        self.mean = self.mean + delta * batch_count / total
+        self.m2 = self.m2 + batch_m2 + delta ** 2 * self.count * batch_count / total
+        self.count = total
+
+    def confidence_interval(self, confidence=0.95):
+        """
+        Returns (mean, low, high) of the normal approximation confidence
+        interval of the mean
+        """
+        if (self.count < 2):
+            return self.mean, -math.inf, math.inf
+        z = statistics.NormalDist().inv_cdf(0.5 + confidence / 2)
+        half_width = z * np.sqrt(self.m2 / (self.count - 1) / self.count)
+        return self.mean, self.mean - half_width, self.mean + half_width
+
+    def to_dict(self, confidence=0.95):
+        mean, low, high = self.confidence_interval(confidence)
+        return { 'mean': np.asarray(mean).tolist(), 'low': np.asarray(low).tolist(), 'high': np.asarray(high).tolist(), 'blocks': self.count }
+
+def get_target_separations(trials, target_index):
+    """
+    Returns (separations, block of each separation): the number of trials
+    between consecutive targets of every block of a (blocks, trials) array
+    """
+    block_index, trial_index = np.nonzero(trials == target_index)
+    same_block = (block_index[1:] == block_index[:-1])
+    return (np.diff(trial_index) - 1)[same_block], block_index[1:][same_block]
+
+def get_run_lengths(trials):
+    """
+    Returns (run lengths, block of each run) of the runs of the same
+    stimulus in every block of a (blocks, trials) array
+    """
+    num_blocks, num_trials = trials.shape
+    starts = np.ones(trials.shape, dtype=bool)
+    starts[:, 1:] = (trials[:, 1:] != trials[:, :-1])
+    start_index = np.flatnonzero(starts)
+    # Every block starts a run, so runs never cross blocks
+    lengths = np.diff(np.append(start_index, num_blocks * num_trials))
+    return lengths, start_index // num_trials
+
+def get_transition_counts(trials, num_stimuli):
+    """
+    Returns the (blocks, stimuli, stimuli) counts of each stimulus
+    (second axis) being followed by each stimulus (third axis)
+    """
+    num_blocks = trials.shape[0]
+    transitions = trials[:, :-1].astype(np.int64) * num_stimuli + trials[:, 1:]
+    transitions += (np.arange(num_blocks) * num_stimuli * num_stimuli)[:, np.newaxis]
+    counts = np.bincount(transitions.reshape(-1), minlength=num_blocks * num_stimuli * num_stimuli)
+    return counts.reshape(num_blocks, num_stimuli, num_stimuli)
+
+def group_reduce(ufunc, values, groups, num_groups):
+    """
+    Returns (reduced values, groups with values) of values sorted by group
+    """
+    counts = np.bincount(groups, minlength=num_groups)
+    nonempty = (counts > 0)
+    starts = (np.cumsum(counts) - counts)[nonempty]
+    return ufunc.reduceat(values, starts), nonempty
+
+class DesignStatistics:
+    """
+    Histograms and running statistics of simulated blocks
+    """
+    def __init__(self, num_stimuli, target_index):
+        self.num_stimuli = num_stimuli
+        self.target_index = target_index
+        self.num_blocks = 0
+        self.separations = Histogram()
+        self.block_min_separations = Histogram()
+        self.block_max_separations = Histogram()
+        self.mean_separation = RunningStatistic()
+        self.run_lengths = Histogram()
+        self.block_max_run_lengths = Histogram()
+        self.mean_run_length = RunningStatistic()
+        self.transition_counts = np.zeros((num_stimuli, num_stimuli), dtype=np.int64)
+        self.transition_frequency = RunningStatistic()
+
+    def add(self, trials):
+        """
+        Adds a (blocks, trials) batch of blocks
+        """
+        num_blocks, num_trials = trials.shape
+        self.num_blocks += num_blocks
+
+        separations, separation_blocks = get_target_separations(trials, self.target_index)
+        self.separations.add(separations)
+        block_min, _ = group_reduce(np.minimum, separations, separation_blocks, num_blocks)
+        block_max, _ = group_reduce(np.maximum, separations, separation_blocks, num_blocks)
+        block_sum, nonempty = group_reduce(np.add, separations, separation_blocks, num_blocks)
+        self.block_min_separations.add(block_min)
+        self.block_max_separations.add(block_max)
+        self.mean_separation.add(block_sum / np.bincount(separation_blocks, minlength=num_blocks)[nonempty])
+
+        lengths, run_blocks = get_run_lengths(trials)
+        self.run_lengths.add(lengths)
+        block_max_run, _ = group_reduce(np.maximum, lengths, run_blocks, num_blocks)
+        self.block_max_run_lengths.add(block_max_run)
+        self.mean_run_length.add(num_trials / np.bincount(run_blocks, minlength=num_blocks))
+
+        transitions = get_transition_counts(trials, self.num_stimuli)
+        self.transition_counts += transitions.sum(axis=0)
+        self.transition_frequency.add(transitions / (num_trials - 1))
+
+    def to_dict(self, confidence=0.95):
+        return { 'num_blocks': self.num_blocks, 'confidence': confidence, 'target_index': self.target_index,
+            'target_separation': { 'histogram': self.separations.to_dict(), 'block_min_histogram': self.block_min_separations.to_dict(),
+                'block_max_histogram': self.block_max_separations.to_dict(), 'block_mean': self.mean_separation.to_dict(confidence) },
+            'run_length': { 'histogram': self.run_lengths.to_dict(), 'block_max_histogram': self.block_max_run_lengths.to_dict(),
+                'block_mean': self.mean_run_length.to_dict(confidence) },
+            'transitions': { 'counts': self.transition_counts.tolist(), 'frequency': self.transition_frequency.to_dict(confidence) } }
+
+def simulate_blocks(trials_per_block, target_trial_percentage, num_stimuli=3, num_blocks=1000000, batch_size=10000, max_rand_targets=0,
+        min_target_separation=0, max_target_separation=math.inf, target_index=0, seed='Pizza'):
+    """
+    Draws num_blocks blocks with the given target under the rules of
+    stim_presentation.generate_design, batch_size blocks at a time.
+    Returns the DesignStatistics of the blocks
+    """
+    rng = np.random.default_rng(stim_presentation.seed_to_int(seed))
+    target_trials_per_block = round(trials_per_block * target_trial_percentage)
+    results = DesignStatistics(num_stimuli, target_index)
+    while (results.num_blocks < num_blocks):
+        batch_blocks = min(batch_size, num_blocks - results.num_blocks)
+        trials = stim_presentation.generate_design(np.full(batch_blocks, target_index), trials_per_block, target_trials_per_block,
+            num_stimuli=num_stimuli, max_rand_targets=max_rand_targets, min_target_separation=min_target_separation,
+            max_target_separation=max_target_separation, rng=rng)
+        results.add(trials)
+    return results
+
+def format_interval(statistic, confidence):
+    mean, low, high = statistic.confidence_interval(confidence)
+    return '{0:.4f} [{1:.4f}, {2:.4f}]'.format(mean, low, high)
+
+def print_statistics(results, confidence):
+    """
+    Prints a summary of simulated DesignStatistics
+    """
+    print('Blocks simulated: {0}'.format(results.num_blocks))
+    print('Mean trials between targets: {0}'.format(format_interval(results.mean_separation, confidence)))
+    separations = results.separations.counts
+    for separation in range(min(separations.size, 5)):
+        print('  {0} trials apart: {1:.4f}'.format(separation, separations[separation] / max(separations.sum(), 1)))
+    block_min = results.block_min_separations.counts
+    if (block_min.size > 0):
+        print('Blocks with back to back targets: {0:.4f}'.format(block_min[0] / results.block_min_separations.counts.sum()))
+    print('Mean run length: {0}'.format(format_interval(results.mean_run_length, confidence)))
+    print('Longest run: {0}'.format(results.block_max_run_lengths.counts.size - 1))
+    mean, low, high = results.transition_frequency.confidence_interval(confidence)
+    print('Transition frequencies (row => column):')
+    for previous in range(results.num_stimuli):
+        print('  ' + '  '.join('{0:.4f} [{1:.4f}, {2:.4f}]'.format(mean[previous, s], low[previous, s], high[previous, s]) for s in range(results.num_stimuli)))
+
+if (__name__ == '__main__'):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('trials', help='Number of trials per block', type=int)
+    parser.add_argument('target_percentage', help='Percentage of trials in a block that are target trials', type=float)
+    parser.add_argument('--stimuli', help='Number of stimuli', type=int, default=3)
+    parser.add_argument('--blocks', help='Number of blocks to simulate', type=int, default=1000000)
+    parser.add_argument('--batch_size', help='Number of blocks drawn at a time', type=int, default=10000)
+    parser.add_argument('--random_targets', help='Adds a random number of target trials to each block', type=int, default=0)
+    parser.add_argument('--min_target_separation', help='Minimum number of trials between two consecutive targets', type=int, default=0)
+    parser.add_argument('--max_target_separation', help='Maximum number of trials between two consecutive targets', type=int, default=None)
+    parser.add_argument('--target', help='Target stimulus of the simulated blocks', type=int, default=0)
+    parser.add_argument('--confidence', help='Confidence level of the intervals', type=float, default=0.95)
+    parser.add_argument('--seed', help='Seed of the simulation', type=str, default='Pizza')
+    parser.add_argument('--out', help='Path to save the histograms and statistics to (JSON)', type=str, default=None)
+    args = parser.parse_args()
+
+    max_target_separation = math.inf if args.max_target_separation is None else args.max_target_separation
+    infeasible = stim_presentation.find_infeasible_block(args.trials, round(args.trials * args.target_percentage), args.stimuli,
+        args.random_targets, args.min_target_separation, max_target_separation)
+    if (infeasible is not None):
+        parser.error('No block with ({0}) targets can meet the target separation limits'.format(infeasible[1]))
+    start = time.perf_counter()
+    results = simulate_blocks(args.trials, args.target_percentage, args.stimuli, args.blocks, args.batch_size, args.random_targets,
+        args.min_target_separation, max_target_separation, args.target, args.seed)
+    print_statistics(results, args.confidence)
+    print('Simulated in {0:.2f}s'.format(time.perf_counter() - start))
+
+    if (args.out is not None):
+        with open(args.out, 'w') as fp:
+            json.dump(results.to_dict(args.confidence), fp, indent=1)
@@ -6,9 +6,23 @@ import math
 import random
 import sys
 import numpy as np
-from itertools import permutations
 import json
 import os.path
+import hashlib
+import functools
+import bisect
+import collections
+from itertools import accumulate
+import batch_runs
+import counterbalancing
+import packed_subject_file
+from instrumentation import get_instrumentation, set_instrumentation, Instrumentation, JsonEventStream, PrintHook
+
+# Bump when a change to the generator changes its output, so existing
+# subject files are regenerated by incremental runs
+GENERATOR_VERSION = 2
+# Records the inputs and files of every generated participant
+MANIFEST_FILENAME = 'manifest.json'
 
 
 class StimPair:
@@ -28,113 +42,114 @@ class StimPair:
 
 def generate_block(num_trials, num_target_trials, target_trial_percentage, target_index, num_stimuli=3, min_target_separation=0, max_target_separation=math.inf, allow_target_repeat=False, verbose=False, **kwargs):
     """
-    Generates an ordering of trials within a block
+    Generates an ordering of trials within a block.
+    Progress is reported as events of the installed instrumentation (see
+    instrumentation.py), verbose prints them when none is installed
     """
+    instruments = get_instrumentation(verbose)
     if kwargs['max_rand_targets']:
         num_target_trials += random.randint(0, kwargs['max_rand_targets'])
-        print(num_target_trials)
+        if (instruments.enabled):
+            instruments.event('random_targets', num_target_trials=num_target_trials)
 
-    # Create stimulus pairings
-    stim_pairs = generate_target_stim_pairings(num_stimuli, num_target_trials, not allow_target_repeat, target_index)
-    if (verbose):
-        print("Generated Stim Pairs:")
-        for pairing in stim_pairs:
-            print(pairing)
+    # Blocks with target separation limits are drawn uniformly from the valid blocks
+    if (separation_constrained(min_target_separation, max_target_separation)):
+        with instruments.timer('constrained_block'):
+            units = generate_block_units(num_trials, num_target_trials, target_index, num_stimuli, allow_target_repeat)
+            return sample_constrained_block(units, min_target_separation, max_target_separation, np.random.default_rng(random.getrandbits(64))).tolist()
 
-    # Get counts for the number of times each stimulus will be presented
-    remaining_trial_counts = generate_remaining_trial_counts(num_trials, num_target_trials, target_index, num_stimuli)
-    if (verbose):
-        print("Remaining Trial Counts: {}".format(remaining_trial_counts))
+    with instruments.timer('block_pairings'):
+        # Create stimulus pairings
+        stim_pairs = generate_target_stim_pairings(num_stimuli, num_target_trials, not allow_target_repeat, target_index)
 
-    free_unpaired_trials = remaining_trial_counts.copy()
-    if (not allow_target_repeat):
-        free_unpaired_trials[target_index] = 0
-    # Loop through the pairs and remove their counts from the counts for free non-target trials
-    for pairing in stim_pairs:
-        free_unpaired_trials[pairing.previous_stim] -= pairing.desired_count
-    if (verbose):
-        print('DEBUG:: Unpaired nontarget trial counts: {0}'.format(free_unpaired_trials))
+        # Get counts for the number of times each stimulus will be presented
+        remaining_trial_counts = generate_remaining_trial_counts(num_trials, num_target_trials, target_index, num_stimuli)
 
-    # Count of the total number of nontarget trials that still need to be added
-    remaining_unpaired_non_target_trials = 0
-    for nontarget in free_unpaired_trials:
-        remaining_unpaired_non_target_trials += free_unpaired_trials[nontarget]
-    if (verbose):
-        print("DEBUG:: Total unpaired non-target trials for this block: {0}".format(remaining_unpaired_non_target_trials))
+        free_unpaired_trials = remaining_trial_counts.copy()
+        if (not allow_target_repeat):
+            free_unpaired_trials[target_index] = 0
+        # Loop through the pairs and remove their counts from the counts for free non-target trials
+        for pairing in stim_pairs:
+            free_unpaired_trials[pairing.previous_stim] -= pairing.desired_count
+
+        # Count of the total number of nontarget trials that still need to be added
+        remaining_unpaired_non_target_trials = 0
+        for nontarget in free_unpaired_trials:
+            remaining_unpaired_non_target_trials += free_unpaired_trials[nontarget]
+
+    if (instruments.enabled):
+        instruments.event('block_start', target_index=target_index, num_trials=num_trials, num_target_trials=num_target_trials,
+            stim_pairs=[str(pairing) for pairing in stim_pairs], trial_counts=dict(remaining_trial_counts),
+            unpaired_counts=dict(free_unpaired_trials), num_unpaired=remaining_unpaired_non_target_trials)
 
     # List of stimuli indices of length num_trials
     # I use -1 as a place holder for no stimulus
     block = [-1] * num_trials
 
-    target_trials_added = 0
-    # index of the stimulus within the block
-    i = 0
-    max_target_separation = round(num_trials / num_target_trials) - 2
-    while (i < len(block)):
-        # Add nontarget trials to the block
-        if (remaining_unpaired_non_target_trials > 0):
-
-            # Determine how many nontarget trials to add
-            if (remaining_unpaired_non_target_trials > 1 ):#and remaining_trial_counts[target_index] > 0):
-                trials_to_add = random.randint(0, remaining_unpaired_non_target_trials)
-                #trials_to_add = random.randint(0, min(remaining_unpaired_non_target_trials, max_target_separation))
-            else:
-                trials_to_add = 1
-            if (verbose):
-                print('DEBUG:: Starting at position ({0}), inserting ({1}) non-target trials'.format(i, trials_to_add))
-
-            # Insert non target trials
-            if verbose:
-                print('DEBUG:: trial counts before update: {}'.format(remaining_trial_counts))
-                print('DEBUG:: unpaired nontarget trial counts before update: {}'.format(free_unpaired_trials))
-            for j in range(trials_to_add):
-                stim_index = choose_available_stimulus(free_unpaired_trials, not allow_target_repeat, target_index)
-                block[i] = stim_index
-                free_unpaired_trials[stim_index] -= 1
-                remaining_trial_counts[stim_index] -= 1
-                remaining_unpaired_non_target_trials -= 1
-                if (verbose):
-                    print('DEBUG:: Placed stimulus ({0}) at position ({1})'.format(stim_index, i))
-                    print('DEBUG:: Update ({0}/{1}) trial counts: {2}'.format(j + 1, trials_to_add,remaining_trial_counts))
-                    print('DEBUG:: Update ({0}/{1}) unpaired non-target trial counts: {2}'.format(j + 1, trials_to_add, free_unpaired_trials))
-                i += 1
-        else:
-            #print('WARNING:: No nontarget trials remaining')
-            pass
-
-        # Add a target trial to the block
-        if (remaining_trial_counts[target_index] > 0):
-            target_trials_added += 1
-            # Get a target pairing
-            pair_index = choose_available_stim_pair(stim_pairs)
-            stim_pairs[pair_index].count += 1
-            # Set the values in the block
-            block[i] = stim_pairs[pair_index].previous_stim
-            block[i + 1] = stim_pairs[pair_index].target_stim
-            # Update remaining trial counts
-            #remaining_unpaired_non_target_trials -= 1
-            remaining_trial_counts[target_index] -= 1
-            remaining_trial_counts[stim_pairs[pair_index].previous_stim] -= 1
-            if (verbose):
-                print('DEBUG:: Added target pair: {0} at position {1}'.format(stim_pairs[pair_index], i))
-                print('DEBUG:: Updated trial counts: {0}'.format(remaining_trial_counts))
-            i += 2
-
-        if (remaining_unpaired_non_target_trials > 1 and remaining_trial_counts[target_index] <= 0):
-            # Loop through and add the remaining stims
-            for stim_index in free_unpaired_trials:
-                for _ in range(free_unpaired_trials[stim_index]):
+    with instruments.timer('block_placement'):
+        target_trials_added = 0
+        # index of the stimulus within the block
+        i = 0
+        while (i < len(block)):
+            # Add nontarget trials to the block
+            if (remaining_unpaired_non_target_trials > 0):
+
+                # Determine how many nontarget trials to add
+                if (remaining_unpaired_non_target_trials > 1 ):#and remaining_trial_counts[target_index] > 0):
+                    trials_to_add = random.randint(0, remaining_unpaired_non_target_trials)
+                else:
+                    trials_to_add = 1
+
+                # Insert non target trials
+                run_start = i
+                for j in range(trials_to_add):
+                    stim_index = choose_available_stimulus(free_unpaired_trials, not allow_target_repeat, target_index)
                     block[i] = stim_index
-                    i += 1
+                    free_unpaired_trials[stim_index] -= 1
                     remaining_trial_counts[stim_index] -= 1
+                    remaining_unpaired_non_target_trials -= 1
+                    i += 1
+                if (instruments.enabled):
+                    instruments.event('nontarget_run', position=run_start, stimuli=block[run_start:i])
+            else:
+                #print('WARNING:: No nontarget trials remaining')
+                pass
 
-    #end while
+            # Add a target trial to the block
+            if (remaining_trial_counts[target_index] > 0):
+                target_trials_added += 1
+                # Get a target pairing
+                pair_index = choose_available_stim_pair(stim_pairs)
+                stim_pairs[pair_index].count += 1
+                # Set the values in the block
+                block[i] = stim_pairs[pair_index].previous_stim
+                block[i + 1] = stim_pairs[pair_index].target_stim
+                # Update remaining trial counts
+                #remaining_unpaired_non_target_trials -= 1
+                remaining_trial_counts[target_index] -= 1
+                remaining_trial_counts[stim_pairs[pair_index].previous_stim] -= 1
+                if (instruments.enabled):
+                    instruments.event('target_pair', position=i, previous=stim_pairs[pair_index].previous_stim, target=stim_pairs[pair_index].target_stim)
+                i += 2
+
+            if (remaining_unpaired_non_target_trials > 1 and remaining_trial_counts[target_index] <= 0):
+                # Loop through and add the remaining stims
+                for stim_index in free_unpaired_trials:
+                    for _ in range(free_unpaired_trials[stim_index]):
+                        block[i] = stim_index
+                        i += 1
+                        remaining_trial_counts[stim_index] -= 1
+
+        #end while
 
     # Check for errors
     for stim_index in remaining_trial_counts:
         if (remaining_trial_counts[stim_index] != 0):
-            print('ERROR:: Stimulus ({0}) has count ({1})'.format(stim_index, remaining_trial_counts[stim_index]))
+            instruments.error('count_mismatch', 'Stimulus ({0}) has count ({1})'.format(stim_index, remaining_trial_counts[stim_index]),
+                stim_index=stim_index, count=remaining_trial_counts[stim_index], target_index=target_index)
 
+    instruments.count('blocks')
+    instruments.count('trials', num_trials)
     assert (len(block) == num_trials)
     return block
 
@@ -183,7 +198,8 @@ def choose_available_stim_pair(stim_pairs):
     available_pairs = get_available_pairs(stim_pairs)
 
     if len(available_pairs) == 0:
-        raise "No available stim pairs"
+        get_instrumentation().error('pair_exhaustion', 'No available stim pairs', stim_pairs=[str(pairing) for pairing in stim_pairs])
+        raise ValueError('No available stim pairs')
 
     return available_pairs[random.randint(0, len(available_pairs) - 1)]
 
@@ -248,7 +264,8 @@ def increment_pairing_count(target_index, nontarget_index, stim_pairs):
             pairing_found = True
 
     if (not pairing_found):
-        print('WARNING:: Could not find valid pairing to increment')
+        get_instrumentation().warning('pairing_not_found', 'Could not find valid pairing to increment',
+            target_index=target_index, nontarget_index=nontarget_index)
 
     return stim_pairs
 
@@ -281,7 +298,8 @@ def choose_available_stimulus(stim_counts, exclude_target, target_index):
     """
     available_stimuli = get_available_stimuli(stim_counts, exclude_target, target_index)
     if (len(available_stimuli) == 0):
-        print('WARNING:: No stimuli available, returning default of (0)')
+        get_instrumentation().warning('stimulus_fallback', 'No stimuli available, returning default of (0)',
+            stim_counts=dict(stim_counts), target_index=target_index)
         return 0
     else:
         return available_stimuli[random.randint(0, len(available_stimuli) - 1)]
@@ -291,12 +309,7 @@ def all_rows_unique(mat):
     Returns true if the all the rows are unique.
     This is for checking to make sure all participants see a different order of blocks
     """
-    num_rows = mat.shape[0]
-    for i in range(num_rows):
-        for j in range(num_rows):
-            if (i != j and np.array_equal(mat[i,:], mat[j,:])):
-                return False
-    return True
+    return counterbalancing.rows_unique(mat)
 
 def create_latin_square(arr):
     """
@@ -308,13 +321,791 @@ def create_latin_square(arr):
         mat[i,:] = np.roll(arr, i)
     return mat
 
+def unrank_permutation(index, num_stimuli):
+    """
+    Returns the permutation of range(num_stimuli) found at the given index
+    of itertools.permutations, without generating the permutations before it
+    """
+    available = list(range(num_stimuli))
+    permutation = []
+    for position in range(num_stimuli):
+        digit, index = divmod(index, math.factorial(num_stimuli - 1 - position))
+        permutation.append(available.pop(digit))
+    return permutation
+
+def unrank_permutations(indices, num_stimuli):
+    """
+    Vectorized unrank_permutation. Returns an int array of shape
+    indices.shape + (num_stimuli,)
+    """
+    if (math.factorial(num_stimuli) > np.iinfo(np.int64).max):
+        raise ValueError('Permutation indices of ({0}) stimuli do not fit in 64 bits'.format(num_stimuli))
+
+    indices = np.asarray(indices, dtype=np.int64)
+    remaining = indices.reshape(-1).copy()
+    available = np.ones((remaining.size, num_stimuli), dtype=bool)
+    orders = np.zeros((remaining.size, num_stimuli), dtype=int)
+    for position in range(num_stimuli):
+        digit, remaining = np.divmod(remaining, math.factorial(num_stimuli - 1 - position))
+        # The stimulus chosen is the digit'th stimulus not used yet
+        chosen = np.argmax(np.cumsum(available, axis=1) > digit[:, np.newaxis], axis=1)
+        orders[:, position] = chosen
+        available[np.arange(remaining.size), chosen] = False
+    return orders.reshape(indices.shape + (num_stimuli,))
+
+def get_prime_residues(num_stimuli):
+    """
+    Returns (radical, residues): the product of the primes up to num_stimuli
+    (the primes dividing num_stimuli!) and the numbers below it that share
+    no factor with it. Every number coprime to num_stimuli! is a residue
+    plus a multiple of the radical
+    """
+    radical = 1
+    for value in range(2, num_stimuli + 1):
+        if (all(value % prime != 0 for prime in range(2, value))):
+            radical *= value
+    return radical, [value for value in range(radical) if math.gcd(value, radical) == 1]
+
+def get_group_step(group, num_stimuli):
+    """
+    Returns the step (coprime to n = num_stimuli!) with which a group of n
+    participants walks through the block orders. Groups 0, 1, ... get every
+    step below n once, in increasing order, then the steps repeat.
+    Group 0 has a step of 1
+    """
+    radical, residues = get_prime_residues(num_stimuli)
+    num_steps = len(residues) * (math.factorial(num_stimuli) // radical)
+    cycle, residue = np.divmod(np.asarray(group, dtype=np.int64) % num_steps, len(residues))
+    return cycle * radical + np.asarray(residues, dtype=np.int64)[residue]
+
+def get_block_order_index(participant, sequence, num_stimuli):
+    """
+    Returns the index (into itertools.permutations) of the block order that a
+    participant hears during a sequence.
+    Every group of n = num_stimuli! participants forms a latin square over the
+    permutations: row r of group g hears (step_g * sequence - r) mod n, where
+    step_g is the get_group_step of the group. Steps are coprime to n, so
+    every row hears each order once in n sequences. The first group matches
+    create_latin_square. Rows are unique for the first n * phi(n)
+    participants (12 for 3 stimuli, 192 for 4, 3840 for 5)
+    """
+    num_permutations = math.factorial(num_stimuli)
+    if ((num_permutations - 1) ** 2 > np.iinfo(np.int64).max):
+        raise ValueError('Block orders of ({0}) stimuli do not fit in 64 bits'.format(num_stimuli))
+    participant, sequence = np.broadcast_arrays(np.asarray(participant, dtype=np.int64), np.asarray(sequence, dtype=np.int64))
+    group, row = np.divmod(participant, num_permutations)
+    return (get_group_step(group, num_stimuli) * (sequence % num_permutations) - row) % num_permutations
+
+def get_block_orders(num_participants, num_sequences, num_stimuli):
+    """
+    Returns the (participants, sequences) matrix of get_block_order_index
+    """
+    participants = np.arange(num_participants, dtype=np.int64)[:, np.newaxis]
+    sequences = np.arange(num_sequences, dtype=np.int64)[np.newaxis, :]
+    return get_block_order_index(participants, sequences, num_stimuli)
+
+def generate_block_units(num_trials, num_target_trials, target_index, num_stimuli, allow_target_repeat=False):
+    """
+    Returns an int8 array of shape (units, 2) describing the contents of a block.
+    Each row is either a target pairing [previous, target] or an unpaired
+    trial [stimulus, -1]. Shuffling the rows and dropping the -1 place holders
+    gives a block with the same counts and pairings as generate_block
+    """
+    remaining_trial_counts = generate_remaining_trial_counts(num_trials, num_target_trials, target_index, num_stimuli)
+    stim_pairs = generate_target_stim_pairings(num_stimuli, num_target_trials, not allow_target_repeat, target_index)
+
+    # Every pairing consumes one presentation of the preceeding stimulus and
+    # one of the target, the rest are presented unpaired
+    free_unpaired_trials = remaining_trial_counts.copy()
+    for pairing in stim_pairs:
+        free_unpaired_trials[pairing.previous_stim] -= pairing.desired_count
+        free_unpaired_trials[pairing.target_stim] -= pairing.desired_count
+
+    for stim_index, count in free_unpaired_trials.items():
+        if (count < 0):
+            raise ValueError('Stimulus ({0}) is paired more often than it is presented ({1} trials short)'.format(stim_index, -count))
+
+    units = []
+    for stim_index, count in free_unpaired_trials.items():
+        units.extend([[stim_index, -1]] * count)
+    for pairing in stim_pairs:
+        units.extend([[pairing.previous_stim, pairing.target_stim]] * pairing.desired_count)
+
+    return np.array(units, dtype=np.int8).reshape(-1, 2)
+
+@functools.lru_cache(maxsize=None)
+def get_block_units(num_trials, num_target_trials, target_index, num_stimuli, allow_target_repeat=False):
+    """
+    Cached, read-only generate_block_units. The units only depend on these
+    arguments, so designs generated in the same process (e.g. every
+    participant of a sweep) share them
+    """
+    units = generate_block_units(num_trials, num_target_trials, target_index, num_stimuli, allow_target_repeat)
+    units.flags.writeable = False
+    return units
+
+def separation_constrained(min_target_separation, max_target_separation):
+    """
+    Returns true if the separation limits rule out any block.
+    Targets are always preceeded by their paired stimulus, so a minimum
+    separation of one trial holds for every block
+    """
+    return min_target_separation > 1 or max_target_separation != math.inf
+
+def random_below(rng, n):
+    """
+    Returns a uniformly random integer in [0, n) for integers of any size
+    """
+    if (n <= np.iinfo(np.int64).max):
+        return int(rng.integers(n))
+    # Draw enough random bits and reject values outside of the range
+    num_bits = n.bit_length()
+    while True:
+        value = int.from_bytes(rng.bytes((num_bits + 7) // 8), 'little') >> (-num_bits % 8)
+        if (value < n):
+            return value
+
+def choose_weighted(rng, weights):
+    """
+    Returns an index into a list of (possibly huge) integer weights, chosen
+    with probability proportional to its weight
+    """
+    cumulative = list(accumulate(weights))
+    return bisect.bisect_right(cumulative, random_below(rng, cumulative[-1]))
+
+@functools.lru_cache(maxsize=None)
+def count_gap_layouts(num_pairs, num_unpaired, min_gap, max_gap):
+    """
+    Counts the ways of spreading num_unpaired trials into the gaps around
+    num_pairs target pairings, when each gap between two pairings holds
+    min_gap to max_gap trials. The gaps before the first and after the last
+    pairing are unbounded.
+    Returns (table, edge_weights) where table[m][n] is the number of ways to
+    fill m bounded gaps with n trials and edge_weights[e] is the number of
+    layouts with e trials in the two unbounded gaps.
+    Results are cached, so blocks sharing parameters share the tables
+    """
+    num_gaps = max(num_pairs - 1, 0)
+    table = [[1] + [0] * num_unpaired]
+    for m in range(num_gaps):
+        previous = table[-1]
+        prefix = [0] + list(accumulate(previous))
+        # row[n] = sum of previous[n - g] for g in [min_gap, max_gap]
+        row = [prefix[max(n - min_gap + 1, 0)] - prefix[max(n - max_gap, 0)] for n in range(num_unpaired + 1)]
+        table.append(row)
+
+    if (num_pairs == 0):
+        edge_weights = [0] * num_unpaired + [1]
+    else:
+        # The edge trials can be split num_edge + 1 ways between the two edges
+        edge_weights = [(e + 1) * table[num_gaps][num_unpaired - e] for e in range(num_unpaired + 1)]
+    return tuple(tuple(row) for row in table), tuple(edge_weights)
+
+def count_constrained_blocks(units, min_target_separation=0, max_target_separation=math.inf):
+    """
+    Returns the exact number of distinct blocks that can be made from the
+    units of generate_block_units while respecting the separation limits.
+    Separation is the number of trials between two consecutive targets
+    """
+    pairs = units[units[:, 1] >= 0]
+    unpaired = units[units[:, 1] < 0]
+    min_gap = max(min_target_separation - 1, 0)
+    max_gap = min(max_target_separation - 1, len(unpaired))
+    if (min_gap > max_gap):
+        return 0
+
+    _, edge_weights = count_gap_layouts(len(pairs), len(unpaired), min_gap, int(max_gap))
+    # Any arrangement of the unpaired stimuli and of the pairings can fill a layout
+    return sum(edge_weights) * multinomial(unpaired[:, 0]) * multinomial(pairs[:, 0])
+
+def multinomial(labels):
+    """
+    Returns the number of distinct orderings of a list of labels
+    """
+    _, counts = np.unique(labels, return_counts=True)
+    result = math.factorial(len(labels))
+    for count in counts:
+        result //= math.factorial(int(count))
+    return result
+
+def find_infeasible_block(trials_per_block, target_trials_per_block, num_stimuli, max_rand_targets=0, min_target_separation=0, max_target_separation=math.inf):
+    """
+    Returns (target index, number of target trials) of the first kind of
+    block that no arrangement can fit within the separation limits, or
+    None if every block of the design can be generated
+    """
+    if (not separation_constrained(min_target_separation, max_target_separation)):
+        return None
+    for num_target_trials in range(target_trials_per_block, target_trials_per_block + max_rand_targets + 1):
+        for target_index in range(num_stimuli):
+            units = get_block_units(trials_per_block, num_target_trials, target_index, num_stimuli)
+            if (count_constrained_blocks(units, min_target_separation, max_target_separation) == 0):
+                return target_index, num_target_trials
+    return None
+
+def sample_constrained_block(units, min_target_separation=0, max_target_separation=math.inf, rng=None):
+    """
+    Draws a block uniformly from every block that can be made from the units
+    of generate_block_units while keeping between min_target_separation and
+    max_target_separation trials between consecutive targets.
+    The gap layout is drawn from the counts of count_gap_layouts, then the
+    unpaired stimuli and pairings are shuffled into it, so no block is ever
+    rejected. Returns an int8 array of the block's trials
+    """
+    if (rng is None):
+        rng = np.random.default_rng()
+
+    units = np.asarray(units, dtype=np.int8)
+    pairs = units[units[:, 1] >= 0]
+    unpaired = units[units[:, 1] < 0, 0]
+    num_pairs = len(pairs)
+    num_unpaired = len(unpaired)
+    min_gap = max(min_target_separation - 1, 0)
+    max_gap = int(min(max_target_separation - 1, num_unpaired))
+    if (min_gap > max_gap):
+        raise ValueError('No block can keep targets {0} to {1} trials apart'.format(min_target_separation, max_target_separation))
+
+    table, edge_weights = count_gap_layouts(num_pairs, num_unpaired, min_gap, max_gap)
+    if (sum(edge_weights) == 0):
+        raise ValueError('No block of ({0}) pairings and ({1}) unpaired trials can keep targets {2} to {3} trials apart'.format(num_pairs, num_unpaired, min_target_separation, max_target_separation))
+
+    # Split the edge trials between the start and end of the block
+    num_edge = choose_weighted(rng, edge_weights)
+    leading = random_below(rng, num_edge + 1)
+    gaps = [leading]
+
+    # Draw each bounded gap given the number of trials left for the rest
+    remaining = num_unpaired - num_edge
+    for m in range(len(table) - 1, 0, -1):
+        sizes = range(min_gap, min(max_gap, remaining) + 1)
+        gap = sizes[choose_weighted(rng, [table[m - 1][remaining - g] for g in sizes])]
+        gaps.append(gap)
+        remaining -= gap
+    gaps.append(num_edge - leading)
+
+    # Fill the layout with shuffled unpaired stimuli and pairings
+    unpaired = rng.permutation(unpaired)
+    pairs = rng.permutation(pairs)
+    if (num_pairs == 0):
+        return unpaired
+    block = np.empty(num_unpaired + 2 * num_pairs, dtype=np.int8)
+    position = 0
+    used = 0
+    for p in range(num_pairs + 1):
+        block[position:position + gaps[p]] = unpaired[used:used + gaps[p]]
+        position += gaps[p]
+        used += gaps[p]
+        if (p < num_pairs):
+            block[position:position + 2] = pairs[p]
+            position += 2
+    return block
+
+def fits_int64(values):
+    return max(values, default=0) <= np.iinfo(np.int64).max
+
+def sample_constrained_blocks(units, num_blocks, min_target_separation=0, max_target_separation=math.inf, rng=None):
+    """
+    Draws num_blocks blocks sharing the same units, each uniformly like
+    sample_constrained_block, with one array operation per gap instead of
+    one Python loop per block. Falls back to sample_constrained_block when
+    the layout counts do not fit in 64 bits.
+    Returns an int8 array of shape (num_blocks, trials)
+    """
+    if (rng is None):
+        rng = np.random.default_rng()
+
+    units = np.asarray(units, dtype=np.int8)
+    pairs = units[units[:, 1] >= 0]
+    unpaired = units[units[:, 1] < 0, 0]
+    num_pairs = len(pairs)
+    num_unpaired = len(unpaired)
+    min_gap = max(min_target_separation - 1, 0)
+    max_gap = int(min(max_target_separation - 1, num_unpaired))
+    if (min_gap > max_gap):
+        raise ValueError('No block can keep targets {0} to {1} trials apart'.format(min_target_separation, max_target_separation))
+
+    table, edge_weights = count_gap_layouts(num_pairs, num_unpaired, min_gap, max_gap)
+    if (sum(edge_weights) == 0):
+        raise ValueError('No block of ({0}) pairings and ({1}) unpaired trials can keep targets {2} to {3} trials apart'.format(num_pairs, num_unpaired, min_target_separation, max_target_separation))
+    if (not fits_int64([sum(edge_weights)] + [max(row) for row in table])):
+        return np.array([sample_constrained_block(units, min_target_separation, max_target_separation, rng) for _ in range(num_blocks)],
+            dtype=np.int8).reshape(num_blocks, num_unpaired + 2 * num_pairs)
+
+    unpaired = rng.permuted(np.tile(unpaired, (num_blocks, 1)), axis=1)
+    if (num_pairs == 0):
+        return unpaired
+
+    # Split the edge trials between the start and end of each block
+    edge_cumulative = np.cumsum(np.array(edge_weights, dtype=np.int64))
+    num_edge = np.searchsorted(edge_cumulative, rng.integers(0, edge_cumulative[-1], size=num_blocks), side='right')
+    leading = rng.integers(0, num_edge + 1)
+
+    # gaps[:, p] is the number of unpaired trials before pairing p
+    gaps = np.empty((num_blocks, num_pairs), dtype=np.int64)
+    gaps[:, 0] = leading
+    table = np.array(table, dtype=np.int64)
+    sizes = np.arange(min_gap, max_gap + 1)
+    remaining = num_unpaired - num_edge
+    for m in range(table.shape[0] - 1, 0, -1):
+        # Weight of each gap size given the trials left for the other gaps
+        left = remaining[:, np.newaxis] - sizes[np.newaxis, :]
+        weights = np.where(left >= 0, table[m - 1][np.maximum(left, 0)], 0)
+        cumulative = np.cumsum(weights, axis=1)
+        chosen = (cumulative <= rng.integers(0, cumulative[:, -1])[:, np.newaxis]).sum(axis=1)
+        gaps[:, table.shape[0] - m] = sizes[chosen]
+        remaining -= sizes[chosen]
+
+    # Pairing p starts after the unpaired trials of the gaps before it
+    before_pair = np.cumsum(gaps, axis=1)
+    pair_positions = before_pair + 2 * np.arange(num_pairs)
+    unpaired_index = np.arange(num_unpaired)
+    pairs_before = (before_pair[:, np.newaxis, :] <= unpaired_index[np.newaxis, :, np.newaxis]).sum(axis=2)
+    unpaired_positions = unpaired_index + 2 * pairs_before
+
+    rows = np.arange(num_blocks)[:, np.newaxis]
+    pairs = pairs[rng.permuted(np.tile(np.arange(num_pairs), (num_blocks, 1)), axis=1)]
+    block = np.empty((num_blocks, num_unpaired + 2 * num_pairs), dtype=np.int8)
+    block[rows, unpaired_positions] = unpaired
+    block[rows, pair_positions] = pairs[:, :, 0]
+    block[rows, pair_positions + 1] = pairs[:, :, 1]
+    return block
+
+def generate_design(target_orders, trials_per_block, target_trials_per_block, num_stimuli=None, max_rand_targets=0, allow_target_repeat=False, min_target_separation=0, max_target_separation=math.inf, rng=None):
+    """
+    Generates the trial order of every block at once.
+    target_orders is an int array of shape (..., blocks) holding the target
+    stimulus of each block (e.g. (participants, sequences, blocks)).
+    If target separation limits are given, each block is drawn with
+    sample_constrained_block instead of shuffling all blocks together.
+    Returns an int8 array of shape target_orders.shape + (trials_per_block,)
+    """
+    if (rng is None):
+        rng = np.random.default_rng()
+    instruments = get_instrumentation()
+
+    target_orders = np.asarray(target_orders, dtype=int)
+    if (num_stimuli is None):
+        num_stimuli = target_orders.shape[-1]
+    flat_targets = target_orders.reshape(-1)
+    num_blocks = flat_targets.size
+
+    # Number of target trials in each block
+    num_target_trials = np.full(num_blocks, target_trials_per_block, dtype=int)
+    if (max_rand_targets):
+        num_target_trials += rng.integers(0, max_rand_targets, size=num_blocks, endpoint=True)
+    instruments.count('blocks', num_blocks)
+    instruments.count('trials', num_blocks * trials_per_block)
+    instruments.count('target_trials', int(num_target_trials.sum()))
+
+    # Fill a padded (blocks, units, 2) array with the units of every block.
+    # Blocks sharing a target and target count share the same units
+    max_units = trials_per_block - int(num_target_trials.min()) if num_blocks else 0
+    units = np.full((num_blocks, max_units, 2), -1, dtype=np.int8)
+    combinations = np.unique(np.stack((flat_targets, num_target_trials), axis=1), axis=0)
+    for target_index, target_count in combinations:
+        block_units = get_block_units(trials_per_block, int(target_count), int(target_index), num_stimuli, allow_target_repeat)
+        selected = (flat_targets == target_index) & (num_target_trials == target_count)
+        units[selected, :block_units.shape[0]] = block_units
+
+    if (separation_constrained(min_target_separation, max_target_separation)):
+        if (allow_target_repeat):
+            raise ValueError('Target separation limits require targets to be excluded from the unpaired trials')
+        # Blocks sharing their units are drawn together
+        trials = np.empty((num_blocks, trials_per_block), dtype=np.int8)
+        for target_index, target_count in combinations:
+            selected = np.flatnonzero((flat_targets == target_index) & (num_target_trials == target_count))
+            block_units = units[selected[0], :trials_per_block - target_count]
+            if (count_constrained_blocks(block_units, min_target_separation, max_target_separation) == 0):
+                instruments.count('infeasible_blocks', selected.size)
+                instruments.error('infeasible_block', 'No block with ({0}) targets of stimulus ({1}) can meet the target separation limits'.format(target_count, target_index),
+                    target_index=int(target_index), num_target_trials=int(target_count), num_blocks=int(selected.size))
+            trials[selected] = sample_constrained_blocks(block_units, selected.size, min_target_separation, max_target_separation, rng)
+            instruments.count('constrained_blocks', selected.size)
+        return trials.reshape(target_orders.shape + (trials_per_block,))
+
+    # Shuffle the units within each block. The padding units are shuffled too,
+    # but they only contain place holders and are dropped below
+    order = rng.permuted(np.tile(np.arange(max_units), (num_blocks, 1)), axis=1)
+    units = np.take_along_axis(units, order[:, :, np.newaxis], axis=1)
+
+    # Every block holds exactly trials_per_block stimuli after removing the
+    # place holders, so the flattened values can be reshaped directly
+    trials = units.reshape(num_blocks, -1)
+    trials = trials[trials >= 0].reshape(target_orders.shape + (trials_per_block,))
+    return trials
+
+def design_to_participant(design, target_orders, target_trial_percentage):
+    """
+    Converts the (sequences, blocks, trials) design and (sequences, blocks)
+    targets of one participant to the dictionary written by export_subjectfile
+    """
+    num_sequences, blocks_per_sequence, trials_per_block = design.shape
+    participant = { 'num_sequences': num_sequences, 'blocks_per_sequence': blocks_per_sequence, 'num_stimuli': blocks_per_sequence,
+    'trials_per_block': trials_per_block, 'target_trial_percentage': target_trial_percentage, 'sequences' : [] }
+
+    for s in range(num_sequences):
+        participant['sequences'].append({ 'targets': target_orders[s].tolist(), 'blocks': design[s].tolist() })
+
+    return participant
+
+def seed_to_int(seed):
+    """
+    Converts a seed (e.g. the string 'Pizza') to an integer that can seed
+    numpy's random number generators the same way on every platform
+    """
+    return int.from_bytes(hashlib.sha256(str(seed).encode('utf-8')).digest()[:8], 'little')
+
+def participant_rng(seed, participant):
+    """
+    Returns the random number generator of a single participant.
+    Each participant gets an independent stream derived from the master seed
+    and their index, so they can be generated in any order or in parallel
+    """
+    return np.random.default_rng(np.random.SeedSequence(seed_to_int(seed), spawn_key=(participant,)))
+
+def generate_participant_design(participant, target_orders, generation_params, seed):
+    """
+    Generates the (sequences, blocks, trials) design of a participant given
+    their (sequences, blocks) target orders. generation_params holds
+    trials_per_block, target_trials_per_block, target_trial_percentage,
+    max_rand_targets and optionally min_target_separation and
+    max_target_separation
+    """
+    return generate_design(target_orders, generation_params['trials_per_block'], generation_params['target_trials_per_block'],
+        max_rand_targets=generation_params['max_rand_targets'],
+        min_target_separation=generation_params.get('min_target_separation', 0),
+        max_target_separation=generation_params.get('max_target_separation', math.inf),
+        rng=participant_rng(seed, participant))
+
+def generate_participant(participant, target_orders, generation_params, seed):
+    """
+    Generates the dictionary of a participant (see generate_participant_design)
+    """
+    design = generate_participant_design(participant, target_orders, generation_params, seed)
+    return design_to_participant(design, target_orders, generation_params['target_trial_percentage'])
+
+def export_participant_chunk(path, participants, target_orders, generation_params, seed, file_format='json'):
+    """
+    Generates and exports the subject files of a list of participants.
+    target_orders holds the (sequences, blocks) targets of each of them.
+    file_format is 'json', 'packed' or 'both'.
+    Returns a dictionary mapping each participant to the sha256 digests of
+    the files written for them
+    """
+    instruments = get_instrumentation()
+    written = {}
+    for participant, participant_targets in zip(participants, target_orders):
+        filename = 'SUBJECT_{0}'.format(participant)
+        with instruments.timer('generate_design'):
+            design = generate_participant_design(participant, participant_targets, generation_params, seed)
+        with instruments.timer('write_subject_files'):
+            file_paths = []
+            if (file_format in ('json', 'both')):
+                file_paths.append(export_subjectfile(path, filename, design_to_participant(design, participant_targets, generation_params['target_trial_percentage'])))
+            if (file_format in ('packed', 'both')):
+                file_paths.append(export_packed_subjectfile(path, filename, design, participant_targets, generation_params['target_trial_percentage']))
+            written[participant] = { os.path.basename(file_path): file_digest(file_path) for file_path in file_paths }
+        instruments.count('participants')
+        instruments.count('subject_files', len(file_paths))
+    return written
+
+def export_instrumented_chunk(path, participants, target_orders, generation_params, seed, file_format='json'):
+    """
+    Runs export_participant_chunk in a worker process with its own
+    instrumentation. Returns (file digests, instrumentation summary) so the
+    parent process can merge the worker's counters and timings
+    """
+    instruments = Instrumentation()
+    previous = set_instrumentation(instruments)
+    try:
+        return export_participant_chunk(path, participants, target_orders, generation_params, seed, file_format), instruments.summary()
+    finally:
+        set_instrumentation(previous)
+
+def export_participants(path, target_orders, generation_params, seed, workers=1, chunk_size=16, file_format='json', participants=None, executor=None):
+    """
+    Generates and exports the subject files of the given participants
+    (all of them by default) from target_orders (participants, sequences,
+    blocks), spreading chunks of participants across a pool of worker
+    processes. Output is the same for any number of workers.
+    An executor shared between runs (see run_batch) is used instead of
+    starting a new pool; at most workers chunks are given to it at a time.
+    Returns the file digests of export_participant_chunk
+    """
+    if (participants is None):
+        participants = range(target_orders.shape[0])
+    participants = list(participants)
+    chunks = [participants[start:start + chunk_size] for start in range(0, len(participants), chunk_size)]
+
+    written = {}
+    # Starting worker processes costs more than generating a single chunk
+    workers = min(workers, len(chunks))
+    if (workers <= 1):
+        for chunk in chunks:
+            written.update(export_participant_chunk(path, chunk, target_orders[chunk], generation_params, seed, file_format))
+        return written
+
+    # Worker processes cannot report to this process's hooks, so when
+    # instrumentation is enabled they send back a summary to merge instead
+    instruments = get_instrumentation()
+    export_chunk = export_instrumented_chunk if instruments.enabled else export_participant_chunk
+
+    def collect(future):
+        if (instruments.enabled):
+            chunk_written, summary = future.result()
+            instruments.merge(summary)
+        else:
+            chunk_written = future.result()
+        written.update(chunk_written)
+
+    own_executor = (executor is None)
+    if (own_executor):
+        # Only imported when a pool is needed, it is slow to import
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(max_workers=workers)
+    try:
+        # A pool of our own has exactly workers processes, a shared one may
+        # have more, so only workers chunks are submitted at a time
+        max_pending = len(chunks) if own_executor else workers
+        pending = collections.deque()
+        for chunk in chunks:
+            if (len(pending) >= max_pending):
+                collect(pending.popleft())
+            pending.append(executor.submit(export_chunk, path, chunk, target_orders[chunk], generation_params, seed, file_format))
+        while (pending):
+            collect(pending.popleft())
+    finally:
+        if (own_executor):
+            executor.shutdown()
+    return written
+
+def file_digest(path):
+    """
+    Returns the sha256 digest of a file's contents
+    """
+    with open(path, 'rb') as fp:
+        return hashlib.sha256(fp.read()).hexdigest()
+
+def get_participant_key(participant, target_orders, generation_params, seed, file_format):
+    """
+    Returns a hash of everything a participant's subject files are generated
+    from: the generator version, parameters, seed, participant index, their
+    (sequences, blocks) targets and the file format
+    """
+    content = { 'version': GENERATOR_VERSION, 'params': generation_params, 'seed': str(seed), 'participant': participant,
+        'targets': np.asarray(target_orders).tolist(), 'format': file_format }
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+
+def load_manifest(path):
+    """
+    Returns the generation manifest of an output directory, mapping each
+    participant index (as a string) to their key and file digests
+    """
+    try:
+        with open(os.path.join(path, MANIFEST_FILENAME), 'r') as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return {}
+
+def save_manifest(path, manifest):
+    file_path_name = os.path.join(path, MANIFEST_FILENAME)
+    with open(file_path_name + '.tmp', 'w') as fp:
+        json.dump(manifest, fp, indent=1, sort_keys=True)
+    os.replace(file_path_name + '.tmp', file_path_name)
+
+def entry_is_current(path, entry, key):
+    """
+    Returns true if a manifest entry was generated with the given key and
+    its files are still on disk unchanged
+    """
+    if (entry is None or entry.get('key') != key):
+        return False
+    for filename, digest in entry.get('files', {}).items():
+        file_path_name = os.path.join(path, filename)
+        if (not os.path.exists(file_path_name) or file_digest(file_path_name) != digest):
+            return False
+    return True
+
+def remove_stale_files(path, entry, files=None):
+    """
+    Deletes the files of a manifest entry that are no longer written (e.g.
+    a participant beyond the current count, or a format that was switched
+    off). Files changed since they were written are left in place and
+    reported. Returns the names of the deleted files
+    """
+    removed = []
+    if (entry is None):
+        return removed
+    for filename, digest in entry.get('files', {}).items():
+        file_path_name = os.path.join(path, filename)
+        if ((files is not None and filename in files) or not os.path.exists(file_path_name)):
+            continue
+        if (file_digest(file_path_name) != digest):
+            print('WARNING:: Not removing {0}, it is no longer generated but was changed since it was written'.format(file_path_name))
+            continue
+        os.remove(file_path_name)
+        removed.append(filename)
+    return removed
+
+def export_participants_incremental(path, target_orders, generation_params, seed, workers=1, file_format='json', force=False, executor=None):
+    """
+    Exports only the participants whose subject files are missing, were
+    changed on disk or were generated from different inputs, recording
+    what was written in the manifest of the output directory.
+    Files the manifest lists that are no longer written (participants beyond
+    the current count, formats no longer exported) are removed from it
+    and deleted with remove_stale_files.
+    Returns (participants that were generated, names of the deleted files)
+    """
+    previous = load_manifest(path)
+    manifest = {} if force else dict(previous)
+    num_participants = target_orders.shape[0]
+    keys = [get_participant_key(p, target_orders[p], generation_params, seed, file_format) for p in range(num_participants)]
+    stale = [p for p in range(num_participants) if not entry_is_current(path, manifest.get(str(p)), keys[p])]
+
+    written = export_participants(path, target_orders, generation_params, seed, workers=workers, file_format=file_format, participants=stale,
+        executor=executor)
+    removed = []
+    for participant, files in written.items():
+        removed += remove_stale_files(path, previous.get(str(participant)), files)
+        manifest[str(participant)] = { 'key': keys[participant], 'files': files }
+    for participant in list(previous):
+        if (not participant.isdigit() or int(participant) >= num_participants):
+            removed += remove_stale_files(path, previous[participant])
+            manifest.pop(participant, None)
+    save_manifest(path, manifest)
+    return stale, removed
+
 def export_subjectfile(path, filename, stim_sequences):
     filename_w_extention = '{0}.json'.format(filename)
     file_path_name = os.path.join(path, filename_w_extention)
     with open(file_path_name, 'w') as fp:
         json.dump(stim_sequences, fp)
+    return file_path_name
 
-if (__name__ == '__main__'):
+def export_packed_subjectfile(path, filename, design, target_orders, target_trial_percentage):
+    """
+    Writes a participant's design to a packed binary subject file
+    (see packed_subject_file.py)
+    """
+    file_path_name = os.path.join(path, '{0}{1}'.format(filename, packed_subject_file.PACKED_EXTENSION))
+    packed_subject_file.write_packed_subject(file_path_name, design, target_orders, target_trial_percentage)
+    return file_path_name
+
+class StudyDesign:
+    """
+    The presentation order of every participant of a study, held in memory.
+    block_orders holds the (participants, sequences) block order indices,
+    target_orders the (participants, sequences, blocks) target of each block
+    and trials the int8 (participants, sequences, blocks, trials) design.
+    The trials of a participant are the same as in the subject files
+    exported with the same parameters and seed
+    """
+    def __init__(self, block_orders, target_orders, trials, generation_params, seed):
+        self.block_orders = block_orders
+        self.target_orders = target_orders
+        self.trials = trials
+        self.generation_params = generation_params
+        self.seed = seed
+
+    def __str__(self):
+        return 'StudyDesign: {0} participants, {1} sequences, {2} blocks, {3} trials per block'.format(*self.trials.shape)
+
+    @property
+    def num_participants(self):
+        return self.trials.shape[0]
+
+    def get_participant(self, participant):
+        """
+        Returns the dictionary written to the participant's SUBJECT_N.json file
+        """
+        return design_to_participant(self.trials[participant], self.target_orders[participant],
+            self.generation_params['target_trial_percentage'])
+
+    def export(self, path, file_format='json'):
+        """
+        Writes the subject file of every participant to path.
+        Returns the paths of the files written
+        """
+        file_paths = []
+        for participant in range(self.num_participants):
+            filename = 'SUBJECT_{0}'.format(participant)
+            if (file_format in ('json', 'both')):
+                file_paths.append(export_subjectfile(path, filename, self.get_participant(participant)))
+            if (file_format in ('packed', 'both')):
+                file_paths.append(export_packed_subjectfile(path, filename, self.trials[participant], self.target_orders[participant],
+                    self.generation_params['target_trial_percentage']))
+        return file_paths
+
+def get_generation_params(trials_per_block, target_trial_percentage, max_rand_targets=0, min_target_separation=0, max_target_separation=math.inf):
+    """
+    Returns the generation_params dictionary of generate_participant_design
+    """
+    generation_params = { 'trials_per_block': trials_per_block, 'target_trials_per_block': round(trials_per_block * target_trial_percentage),
+        'target_trial_percentage': target_trial_percentage, 'max_rand_targets': max_rand_targets }
+    if (separation_constrained(min_target_separation, max_target_separation)):
+        generation_params['min_target_separation'] = min_target_separation
+        generation_params['max_target_separation'] = max_target_separation
+    return generation_params
+
+def get_study_block_orders(num_participants, num_sequences, num_stimuli, design='latin', seed='Pizza'):
+    """
+    Returns the (participants, sequences) block order indices of a study.
+    design is 'latin' (latin squares over the block permutations) or
+    'williams' (balanced Williams designs, see counterbalancing.py)
+    """
+    if (design == 'williams'):
+        rng = np.random.default_rng(seed_to_int(seed))
+        return counterbalancing.design_block_orders(num_participants, num_sequences, num_stimuli, rng=rng)
+    return get_block_orders(num_participants, num_sequences, num_stimuli)
+
+def generate_study_trials(target_orders, generation_params, seed):
+    """
+    Returns the (participants, sequences, blocks, trials) design of every
+    participant given their (participants, sequences, blocks) targets
+    """
+    trials = np.empty(target_orders.shape + (generation_params['trials_per_block'],), dtype=np.int8)
+    for participant in range(target_orders.shape[0]):
+        trials[participant] = generate_participant_design(participant, target_orders[participant], generation_params, seed)
+    return trials
+
+def generate_study(num_participants, num_sequences, num_stimuli, trials_per_block, target_trial_percentage, max_rand_targets=0,
+        min_target_separation=0, max_target_separation=math.inf, design='latin', seed='Pizza', block_orders=None):
+    """
+    Generates the StudyDesign of every participant in memory, without
+    writing any files. block_orders can be passed to reuse the block orders
+    of another study (see get_study_block_orders)
+    """
+    if (block_orders is None):
+        block_orders = get_study_block_orders(num_participants, num_sequences, num_stimuli, design, seed)
+    target_orders = unrank_permutations(block_orders, num_stimuli)
+    generation_params = get_generation_params(trials_per_block, target_trial_percentage, max_rand_targets, min_target_separation, max_target_separation)
+    return StudyDesign(block_orders, target_orders, generate_study_trials(target_orders, generation_params, seed), generation_params, seed)
+
+def sweep_studies(num_participants, num_sequences, num_stimuli, trials_per_block_values, target_percentage_values, random_targets_values=(0,),
+        min_target_separation=0, max_target_separation=math.inf, design='latin', seed='Pizza'):
+    """
+    Generates a StudyDesign for every combination of trials per block,
+    target percentage and random targets in one process. The block orders
+    are computed once, and block units are shared through get_block_units.
+    Returns a dictionary mapping (trials_per_block, target_percentage,
+    random_targets) to its StudyDesign
+    """
+    block_orders = get_study_block_orders(num_participants, num_sequences, num_stimuli, design, seed)
+    studies = {}
+    for trials_per_block in trials_per_block_values:
+        for target_trial_percentage in target_percentage_values:
+            for max_rand_targets in random_targets_values:
+                studies[(trials_per_block, target_trial_percentage, max_rand_targets)] = generate_study(num_participants, num_sequences,
+                    num_stimuli, trials_per_block, target_trial_percentage, max_rand_targets, min_target_separation, max_target_separation,
+                    seed=seed, block_orders=block_orders)
+    return studies
+
+def main(argv=None, executor=None):
+    """
+    Runs the command line with the given arguments (sys.argv by default).
+    executor is a process pool shared with other runs (see run_batch)
+    """
     # Get the command line args
     parser = argparse.ArgumentParser()
     parser.add_argument('sequences', help='Number of sequences per participant', type=int)
@@ -325,9 +1116,77 @@ if (__name__ == '__main__'):
     parser.add_argument('participants', help='Number of participants', type=int)
     parser.add_argument('--random_targets', help='Adds a random number of target trials \
         to each block [0, arg)', type=int, default=0, metavar='random_targets')
+    parser.add_argument('--min_target_separation', help='Minimum number of trials between \
+        two consecutive targets', type=int, default=0)
+    parser.add_argument('--max_target_separation', help='Maximum number of trials between \
+        two consecutive targets', type=int, default=None)
+    parser.add_argument('--design', help='How block orders are assigned to participants: \
+        latin (latin squares over the block permutations) or williams (balanced Williams designs)', \
+        choices=['latin', 'williams'], default='latin')
+    parser.add_argument('--seed', help='Master seed that every participant\'s random stream is derived from', \
+        type=str, default='Pizza')
+    parser.add_argument('--workers', help='Number of processes used to generate participants', \
+        type=int, default=os.cpu_count())
+    parser.add_argument('--format', help='Subject file format: json, packed (binary, see packed_subject_file.py) or both', \
+        choices=['json', 'packed', 'both'], default='json')
+    parser.add_argument('--out', help='Directory to write the subject files to', type=str, default='./out')
+    parser.add_argument('--force', help='Regenerate every participant, even those whose files are up to date', \
+        action='store_true', default=False)
+    parser.add_argument('--metrics', help='Path to save counters and per-stage timings to (JSON)', \
+        type=str, default=None)
+    parser.add_argument('--events', help='Path to stream generator events to (one JSON object per line)', \
+        type=str, default=None)
     parser.add_argument('--verbose', help='Verbose Output', action='store_true', default=False)
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    check_arguments(parser, args)
 
+    # Instrumentation is only installed when something consumes it
+    instruments = None
+    previous_instruments = None
+    events_fp = None
+    if (args.metrics is not None or args.events is not None or args.verbose):
+        instruments = Instrumentation()
+        if (args.verbose):
+            instruments.add_hook(PrintHook())
+        if (args.events is not None):
+            events_fp = open(args.events, 'w')
+            instruments.add_hook(JsonEventStream(events_fp))
+        previous_instruments = set_instrumentation(instruments)
+
+    # A run that fails (e.g. in a batch) must not leave its instrumentation
+    # installed or its events file open for the next one
+    try:
+        run_generator(args, executor)
+        if (args.metrics is not None):
+            with open(args.metrics, 'w') as fp:
+                json.dump(instruments.summary(), fp, indent=2)
+    finally:
+        if (events_fp is not None):
+            events_fp.close()
+        if (instruments is not None):
+            set_instrumentation(previous_instruments)
+
+def check_arguments(parser, args):
+    """
+    Rejects separation limits that no block can meet through parser.error,
+    before any work is done or any output file is opened
+    """
+    max_target_separation = math.inf if args.max_target_separation is None else args.max_target_separation
+    try:
+        infeasible = find_infeasible_block(args.trials, round(args.trials * args.target_percentage), args.blocks,
+            args.random_targets, args.min_target_separation, max_target_separation)
+    except ValueError as error:
+        parser.error(str(error))
+    if (infeasible is not None):
+        limits = ('at least {0}'.format(args.min_target_separation) if max_target_separation == math.inf
+            else '{0} to {1}'.format(args.min_target_separation, max_target_separation))
+        parser.error('No block of ({0}) trials with ({1}) targets can keep targets {2} trials apart'.format(args.trials, infeasible[1], limits))
+
+def run_generator(args, executor=None):
+    """
+    Generates and exports the participants of the parsed command line
+    arguments (see check_arguments)
+    """
     # Default generation parameters
     num_sequences = 15
     blocks_per_sequence = 3
@@ -341,10 +1200,11 @@ if (__name__ == '__main__'):
     target_trial_percentage = args.target_percentage
     num_participants = args.participants
     max_rand_targets = args.random_targets
+    min_target_separation = args.min_target_separation
+    max_target_separation = math.inf if args.max_target_separation is None else args.max_target_separation
 
-    # Seed the random number generator
-    rand_seed = 'Pizza'
-    random.seed(a=rand_seed)
+    # Participants each derive their own random stream from this seed
+    rand_seed = args.seed
 
     # Calculate additional configuration details
     total_trials = num_sequences * blocks_per_sequence * trials_per_block
@@ -352,36 +1212,50 @@ if (__name__ == '__main__'):
     num_stimuli = blocks_per_sequence
 
     # Create the block orderings for each participant
-    block_permutations = np.array(list(permutations(list(range(num_stimuli)))))
-
-    num_permutations = block_permutations.shape[0]
-
-    latin_square = create_latin_square(np.array(list(range(num_permutations)), dtype=int))
-    block_orders = np.concatenate((latin_square, np.fliplr(latin_square)), axis=0)
-    block_orders = np.concatenate((block_orders, np.roll(np.flipud(latin_square), 1, axis=1)), axis=0)
-    block_orders = np.concatenate((block_orders, np.flipud(block_orders)), axis=1)
-    block_orders = np.concatenate((block_orders, block_orders), axis=1)
-    block_orders = block_orders[:num_participants,:num_sequences]
+    with get_instrumentation().timer('block_orders'):
+        block_orders = get_study_block_orders(num_participants, num_sequences, num_stimuli, args.design, rand_seed)
 
     if (not all_rows_unique(block_orders)):
         print("WARNING:: Not all participants have unique block orders")
 
+    # Targets of every block for every participant (participants, sequences, blocks)
+    target_orders = unrank_permutations(block_orders, num_stimuli)
 
-    for p in range(num_participants):
-        participant = { 'num_sequences': num_sequences, 'blocks_per_sequence': blocks_per_sequence, 'num_stimuli': num_stimuli,
-        'trials_per_block': trials_per_block, 'target_trial_percentage': target_trial_percentage, 'sequences' : [] }
+    if (args.verbose):
+        for target_index in range(num_stimuli):
+            print('Block units for target ({0}):'.format(target_index))
+            print(generate_block_units(trials_per_block, target_trials_per_block, target_index, num_stimuli))
 
-        for s in range(num_sequences):
-            sequence = {'targets': [],'blocks': [] }
+    # Generate and export every participant's stimuli presentation file
+    generation_params = get_generation_params(trials_per_block, target_trial_percentage, max_rand_targets, min_target_separation, max_target_separation)
+    os.makedirs(args.out, exist_ok=True)
+    with get_instrumentation().timer('export'):
+        generated, removed = export_participants_incremental(args.out, target_orders, generation_params, rand_seed, workers=args.workers,
+            file_format=args.format, force=args.force, executor=executor)
+    print('Generated ({0}) of ({1}) participants'.format(len(generated), num_participants))
+    if (removed):
+        print('Removed ({0}) subject files that are no longer generated'.format(len(removed)))
 
-            blocks = []
-            target_indices = block_permutations[block_orders[p,s],:]
-            sequence['targets'] = target_indices.tolist()
-            for target_index in target_indices:
-                blocks.append(generate_block(trials_per_block, target_trials_per_block, target_trial_percentage, int(target_index), max_rand_targets=max_rand_targets, verbose=args.verbose))
 
-            sequence['blocks'] = (blocks.copy())
-            participant['sequences'].append(sequence.copy())
+def run_batch(batch_path):
+    """
+    Runs the command line once for every line of a file (- for stdin), e.g.
+        15 3 45 0.33 10 --seed A --out out/condition_a
+    so any number of conditions only pay for starting Python and importing
+    numpy once (see batch_runs.run_batch). Every line shares one pool of
+    worker processes, started when the first line needs it, since starting
+    processes is slow (especially on Windows, where each one imports the
+    generator again).
+    Returns the number of lines that failed
+    """
+    # Imported here rather than at start up, it is slow to import
+    from concurrent.futures import ProcessPoolExecutor
+    # Processes are only started once chunks are submitted to the pool
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        return batch_runs.run_batch(batch_path, lambda arguments: main(arguments, executor))
 
-        # Export the participants stimuli presentation file
-        export_subjectfile('./out', 'SUBJECT_{0}'.format(p), participant)
\ No newline at end of file
+if (__name__ == '__main__'):
+    # python stim_presentation.py batch conditions.txt
+    if (len(sys.argv) == 3 and sys.argv[1] == 'batch'):
+        sys.exit(1 if run_batch(sys.argv[2]) > 0 else 0)
+    main()
@@ -1,4 +1,25 @@
+import argparse
+import functools
+import glob
+import json
+import math
+import os
+import re
+import time
 import numpy as np
+import packed_subject_file
+import recording_io
+import stim_presentation
+
+# Names of the stimuli by the direction they are played from
+STIMULUS_NAMES = ['left', 'middle', 'right']
+# Added to the event code of target trials (see StimPresenter.EncodeEvent)
+TARGET_EVENT_FLAG = 1 << 2
+# Recordings exported by SimpleDataManager.ExportData
+RECORDING_PATTERN = re.compile(r'Subject_(\d+)_Data\.csv$')
+# Event counts of every audited recording, kept in the data directory
+AUDIT_CACHE_FILENAME = 'audit_cache.json'
+AUDIT_CACHE_VERSION = 1
 
 def print_info(participant_config):
     """
@@ -12,34 +33,505 @@ def print_actual_sequence_info(participant_config):
     Determines the number of each type of trial and prints
     the results
     """
+    blocks, targets = subject_to_arrays(participant_config)
     num_stimuli = participant_config['num_stimuli']
+    target_trials, nontarget_trials = count_trial_types(blocks, targets, num_stimuli)
+
+    for stim_index in range(num_stimuli):
+        print('non-target/{0}: {1}'.format(get_stimulus_name(stim_index, num_stimuli), nontarget_trials[stim_index]))
+    for stim_index in range(num_stimuli):
+        print('target/{0}: {1}'.format(get_stimulus_name(stim_index, num_stimuli), target_trials[stim_index]))
+
+def get_stimulus_name(stim_index, num_stimuli):
+    """
+    Returns the name used when printing a stimulus. The three stimuli of
+    the experiment are named by the direction they are played from
+    """
+    if (num_stimuli == len(STIMULUS_NAMES)):
+        return STIMULUS_NAMES[stim_index]
+    return str(stim_index)
+
+def subject_to_arrays(participant_config):
+    """
+    Returns the (sequences, blocks, trials) trial array and the
+    (sequences, blocks) target array of a participant dictionary
+    """
+    blocks = np.array([sequence['blocks'] for sequence in participant_config['sequences']], dtype=np.int64)
+    targets = np.array([sequence['targets'] for sequence in participant_config['sequences']], dtype=np.int64)
+    num_sequences = len(participant_config['sequences'])
+    blocks_per_sequence = participant_config['blocks_per_sequence']
+    return blocks.reshape(num_sequences, blocks_per_sequence, -1), targets.reshape(num_sequences, blocks_per_sequence)
+
+def count_trial_types(blocks, targets, num_stimuli):
+    """
+    Returns the number of (target, non-target) trials of each stimulus
+    """
+    is_target = (blocks == targets[..., np.newaxis])
+    target_trials = np.bincount(blocks[is_target], minlength=num_stimuli)
+    nontarget_trials = np.bincount(blocks[~is_target], minlength=num_stimuli)
+    return target_trials, nontarget_trials
+
+def get_expected_block_counts(num_trials, num_target_trials, target_index, num_stimuli):
+    """
+    Returns (trial counts, pair counts) that a block is generated with:
+    the number of presentations of each stimulus and the number of times
+    each stimulus preceeds the target
+    """
+    trial_counts = stim_presentation.generate_remaining_trial_counts(num_trials, num_target_trials, target_index, num_stimuli)
+    pair_counts = np.zeros(num_stimuli, dtype=np.int64)
+    for pairing in stim_presentation.generate_target_stim_pairings(num_stimuli, num_target_trials, True, target_index):
+        pair_counts[pairing.previous_stim] = pairing.desired_count
+    return np.array([trial_counts[s] for s in range(num_stimuli)], dtype=np.int64), pair_counts
+
+def validate_subject_file(path, min_target_separation=0, max_target_separation=math.inf):
+    """
+    Checks the blocks of a SUBJECT_N.json file against the design they are
+    generated from: block lengths, target and non-target counts, the
+    StimPair balance of the stimuli preceeding targets and the spacing of
+    targets. All checks run on the whole (sequences, blocks, trials) array.
+    Returns a summary dictionary
+    """
+    if (path.endswith(packed_subject_file.PACKED_EXTENSION)):
+        packed = packed_subject_file.read_packed_subject(path)
+        participant_config = { 'num_sequences': packed.num_sequences, 'blocks_per_sequence': packed.blocks_per_sequence,
+            'num_stimuli': packed.num_stimuli, 'trials_per_block': packed.trials_per_block,
+            'target_trial_percentage': packed.target_trial_percentage }
+    else:
+        with open(path, 'r') as fp:
+            participant_config = json.load(fp)
+
+    summary = { 'file': os.path.basename(path), 'valid': True, 'errors': [] }
+    def report(message):
+        summary['valid'] = False
+        summary['errors'].append(message)
+
+    num_stimuli = participant_config['num_stimuli']
+    trials_per_block = participant_config['trials_per_block']
+    try:
+        if ('sequences' in participant_config):
+            blocks, targets = subject_to_arrays(participant_config)
+        else:
+            blocks, targets = np.asarray(packed.blocks, dtype=np.int64), np.asarray(packed.targets, dtype=np.int64)
+    except ValueError:
+        report('Blocks do not all hold {0} trials'.format(trials_per_block))
+        return summary
+    if (blocks.shape[2] != trials_per_block):
+        report('Blocks hold {0} trials instead of {1}'.format(blocks.shape[2], trials_per_block))
+        return summary
+    if (blocks.shape[0] != participant_config['num_sequences']):
+        report('File holds {0} sequences instead of {1}'.format(blocks.shape[0], participant_config['num_sequences']))
+
+    is_target = (blocks == targets[..., np.newaxis])
+    num_target_trials = is_target.sum(axis=2)
+    target_trials, nontarget_trials = count_trial_types(blocks, targets, num_stimuli)
+    summary['num_blocks'] = int(num_target_trials.size)
+    summary['target_trials'] = target_trials.tolist()
+    summary['nontarget_trials'] = nontarget_trials.tolist()
+
+    minimum_targets = round(trials_per_block * participant_config['target_trial_percentage'])
+    num_short = int((num_target_trials < minimum_targets).sum())
+    if (num_short > 0):
+        report('{0} blocks have fewer than {1} targets'.format(num_short, minimum_targets))
+
+    # Per block counts of each stimulus and of each stimulus preceeding a target
+    one_hot = (blocks[..., np.newaxis] == np.arange(num_stimuli))
+    stimulus_counts = one_hot.sum(axis=2)
+    pair_counts = (one_hot[:, :, :-1] & is_target[:, :, 1:, np.newaxis]).sum(axis=2)
+
+    # Blocks sharing a target and target count are expected to share counts
+    expected_counts = np.zeros_like(stimulus_counts)
+    expected_pairs = np.zeros_like(pair_counts)
+    combinations = np.unique(np.stack((targets.reshape(-1), num_target_trials.reshape(-1)), axis=1), axis=0)
+    for target_index, target_count in combinations:
+        selected = (targets == target_index) & (num_target_trials == target_count)
+        expected_counts[selected], expected_pairs[selected] = get_expected_block_counts(trials_per_block, int(target_count), int(target_index), num_stimuli)
+
+    num_unbalanced = int((stimulus_counts != expected_counts).any(axis=2).sum())
+    if (num_unbalanced > 0):
+        report('{0} blocks do not have the expected stimulus counts'.format(num_unbalanced))
+    num_unpaired = int((pair_counts != expected_pairs).any(axis=2).sum())
+    if (num_unpaired > 0):
+        report('{0} blocks do not match the expected target pairings'.format(num_unpaired))
+
+    # Number of trials between consecutive targets of the same block
+    sequence_index, block_index, trial_index = np.nonzero(is_target)
+    same_block = (sequence_index[1:] == sequence_index[:-1]) & (block_index[1:] == block_index[:-1])
+    separations = (np.diff(trial_index) - 1)[same_block]
+    if (separations.size > 0):
+        summary['min_target_separation'] = int(separations.min())
+        summary['max_target_separation'] = int(separations.max())
+        if (summary['min_target_separation'] < max(min_target_separation, 1)):
+            report('Targets are only {0} trials apart'.format(summary['min_target_separation']))
+        if (summary['max_target_separation'] > max_target_separation):
+            report('Targets are up to {0} trials apart'.format(summary['max_target_separation']))
+
+    return summary
+
+def validate_subject_directory(path, workers=1, min_target_separation=0, max_target_separation=math.inf, packed=False):
+    """
+    Validates every SUBJECT_*.json file in a directory across a pool of
+    worker processes. Packed subject files are validated instead when
+    packed is true. Returns one summary dictionary for the whole pool
+    """
+    extension = packed_subject_file.PACKED_EXTENSION if packed else '.json'
+    paths = sorted(glob.glob(os.path.join(path, 'SUBJECT_*{0}'.format(extension))))
+    validate = functools.partial(validate_subject_file, min_target_separation=min_target_separation, max_target_separation=max_target_separation)
+
+    if (workers <= 1):
+        subjects = [validate(subject_path) for subject_path in paths]
+    else:
+        # Only imported when a pool is needed, it is slow to import
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            subjects = list(executor.map(validate, paths, chunksize=max(1, len(paths) // (4 * workers))))
+
+    num_valid = sum(1 for subject in subjects if subject['valid'])
+    return { 'directory': path, 'num_subjects': len(subjects), 'num_valid': num_valid,
+        'num_invalid': len(subjects) - num_valid, 'subjects': subjects }
+
+def get_planned_event_codes(participant_config):
+    """
+    Returns the event codes the game records for every trial of a
+    participant, in presentation order. Matches StimPresenter.EncodeEvent:
+    non-targets are stimulus + 1 (1-3) and targets have TARGET_EVENT_FLAG added
+    """
+    blocks, targets = subject_to_arrays(participant_config)
+    is_target = (blocks == targets[..., np.newaxis])
+    return (blocks + 1 + np.where(is_target, TARGET_EVENT_FLAG, 0)).reshape(-1)
+
+def align_event_codes(planned, recorded, band=50):
+    """
+    Aligns the planned and recorded event codes with an edit distance that is
+    only computed within band trials of the diagonal. Each row of the table is
+    computed with array operations (insertions via a running minimum).
+    Returns a list of (operation, planned index, recorded index) for every
+    difference, where operation is 'dropped', 'extra' or 'mismatch'.
+    Differences that drift further than band trials apart are reported as
+    mismatches rather than the shortest alignment
+    """
+    planned = np.asarray(planned, dtype=np.int64)
+    recorded = np.asarray(recorded, dtype=np.int64)
+    n = planned.size
+    m = recorded.size
+    infinity = n + m + 1
+
+    # Columns [lows[i], highs[i]] of row i are inside the band
+    rows_index = np.arange(n + 1)
+    lows = np.maximum(0, rows_index - band - max(0, n - m))
+    highs = np.minimum(m, rows_index + band + max(0, m - n))
+
+    def get_row_values(table, i, columns):
+        values = np.full(columns.size, infinity, dtype=np.int64)
+        inside = (columns >= lows[i]) & (columns <= highs[i])
+        values[inside] = table[i][columns[inside] - lows[i]]
+        return values
+
+    table = [np.arange(lows[0], highs[0] + 1, dtype=np.int64)]
+    for i in range(1, n + 1):
+        columns = np.arange(lows[i], highs[i] + 1)
+        # Planned trial i - 1 was dropped
+        costs = get_row_values(table, i - 1, columns) + 1
+        # Planned trial i - 1 was recorded as event j - 1
+        matched = columns >= 1
+        diagonal = get_row_values(table, i - 1, columns[matched] - 1) + (planned[i - 1] != recorded[columns[matched] - 1])
+        costs[matched] = np.minimum(costs[matched], diagonal)
+        # Recorded events that were not planned: D[i][j] = min(costs[j], D[i][j - 1] + 1)
+        table.append(columns + np.minimum.accumulate(costs - columns))
+
+    def get_value(i, j):
+        if (i < 0 or j < lows[i] or j > highs[i]):
+            return infinity
+        return table[i][j - lows[i]]
 
-    # Hold the counts of the number of trials
-    target_trials = np.zeros(num_stimuli)
-    nontarget_trials = np.zeros(num_stimuli)
-
-    for sequence in participant_config['sequences']:
-        for block_index in range(participant_config['blocks_per_sequence']):
-            # What stimulus is the current target
-            target_index = sequence['targets'][block_index]
-            for trial in sequence['blocks'][block_index]:
-                if trial == target_index:
-                    target_trials[trial] += 1
-                else:
-                    nontarget_trials[trial] += 1
-
-    print('non-target/left: {}'.format(nontarget_trials[0]))
-    print('non-target/middle: {}'.format(nontarget_trials[1]))
-    print('non-target/right: {}'.format(nontarget_trials[2]))
-    print('target/left: {}'.format(target_trials[0]))
-    print('target/middle: {}'.format(target_trials[1]))
-    print('target/right: {}'.format(target_trials[2]))
-
-def verify_data_file(path):
+    differences = []
+    i, j = n, m
+    while (i > 0 or j > 0):
+        value = get_value(i, j)
+        if (i > 0 and j > 0 and get_value(i - 1, j - 1) + (planned[i - 1] != recorded[j - 1]) == value):
+            if (planned[i - 1] != recorded[j - 1]):
+                differences.append(('mismatch', i - 1, j - 1))
+            i -= 1
+            j -= 1
+        elif (i > 0 and get_value(i - 1, j) + 1 == value):
+            differences.append(('dropped', i - 1, j))
+            i -= 1
+        else:
+            differences.append(('extra', i, j - 1))
+            j -= 1
+    differences.reverse()
+    return differences
+
+def check_recorded_sequence(participant_config, data_path, band=50, chunk_size=recording_io.DEFAULT_CHUNK_SIZE):
+    """
+    Compares the trials planned in a participant's subject file with the
+    event onsets of their recording and returns a summary of the dropped,
+    duplicated, extra and mismatched (e.g. shifted) trials
+    """
+    planned = get_planned_event_codes(participant_config)
+    onset_samples, recorded = recording_io.read_event_onsets(data_path, chunk_size)
+    trials_shape = (participant_config['num_sequences'], participant_config['blocks_per_sequence'], participant_config['trials_per_block'])
+
+    def describe(planned_index, recorded_index, was_recorded=True):
+        issue = {}
+        if (planned_index < planned.size):
+            sequence, block, trial = np.unravel_index(planned_index, trials_shape)
+            issue.update({ 'sequence': int(sequence), 'block': int(block), 'trial': int(trial), 'expected': int(planned[planned_index]) })
+        if (not was_recorded):
+            # recorded_index is the next onset after the dropped trial, not the trial itself
+            issue.update({ 'sample': None, 'recorded': None })
+        elif (recorded_index < recorded.size):
+            issue.update({ 'sample': int(onset_samples[recorded_index]), 'recorded': int(recorded[recorded_index]) })
+        return issue
+
+    summary = { 'planned': int(planned.size), 'recorded': int(recorded.size),
+        'dropped': [], 'duplicated': [], 'extra': [], 'mismatched': [] }
+    for operation, planned_index, recorded_index in align_event_codes(planned, recorded, band):
+        issue = describe(planned_index, recorded_index, operation != 'dropped')
+        if (operation == 'dropped'):
+            summary['dropped'].append(issue)
+        elif (operation == 'mismatch'):
+            summary['mismatched'].append(issue)
+        elif ((recorded_index > 0 and recorded[recorded_index - 1] == recorded[recorded_index])
+            or (recorded_index + 1 < recorded.size and recorded[recorded_index + 1] == recorded[recorded_index])):
+            # The extra event repeats one of its neighbours
+            summary['duplicated'].append(issue)
+        else:
+            summary['extra'].append(issue)
+    summary['matched'] = summary['planned'] - len(summary['dropped']) - len(summary['mismatched'])
+    return summary
+
+class RecordingMonitor:
+    """
+    Follows a recording while the game is writing it and compares it with
+    the participant's subject file. Every update only parses the lines
+    appended since the last one, so its cost does not depend on the length
+    of the recording. Tracks the number of samples of each event code (as
+    verify_data_file prints them), the number of event onsets (trials) of
+    each code against the number expected after that many planned trials,
+    and the first trial whose code differs from the plan
+    """
+    def __init__(self, participant_config, data_path):
+        self.participant_config = participant_config
+        self.planned = get_planned_event_codes(participant_config)
+        # expected_counts[i, code] is the number of code onsets in the first i planned trials
+        one_hot = (self.planned[:, np.newaxis] == np.arange(self.planned.max(initial=0) + 1))
+        self.expected_counts = np.concatenate((np.zeros((1, one_hot.shape[1]), dtype=np.int64), np.cumsum(one_hot, axis=0)))
+        self.tail = recording_io.RecordingTail(data_path)
+        self.reset()
+
+    def reset(self):
+        self.events = recording_io.EventCounter()
+        self.num_onsets = 0
+        self.first_mismatch = None
+
+    def update(self, chunk_size=recording_io.DEFAULT_CHUNK_SIZE):
+        """
+        Parses the complete lines appended since the last update.
+        Returns the number of new samples
+        """
+        lines = self.tail.read_lines(chunk_size)
+        if (self.tail.restarted):
+            print('WARNING:: {0} got shorter, starting over'.format(self.tail.path))
+            self.reset()
+        event_codes = recording_io.parse_event_column(lines)
+        if (event_codes.size == 0):
+            return 0
+        onset_codes = event_codes[self.events.update(event_codes)]
+
+        if (self.first_mismatch is None):
+            planned = self.planned[self.num_onsets:self.num_onsets + onset_codes.size]
+            differences = np.flatnonzero(planned != onset_codes[:planned.size])
+            if (differences.size > 0):
+                self.first_mismatch = self.num_onsets + int(differences[0])
+        self.num_onsets += onset_codes.size
+        return event_codes.size
+
+    def get_progress(self):
+        """
+        Returns a dictionary of the observed and expected counts so far
+        """
+        expected = self.expected_counts[min(self.num_onsets, self.planned.size)]
+        onset_counts = self.events.onset_counts
+        num_codes = max(expected.size, onset_counts.size)
+        observed = np.zeros(num_codes, dtype=np.int64)
+        observed[:onset_counts.size] = onset_counts
+        expected = np.concatenate((expected, np.zeros(num_codes - expected.size, dtype=np.int64)))
+
+        progress = { 'samples': self.events.num_samples, 'trials': self.num_onsets, 'planned': int(self.planned.size), 'codes': {} }
+        for event_code in np.flatnonzero(observed + expected):
+            progress['codes'][str(event_code)] = { 'observed': int(observed[event_code]), 'expected': int(expected[event_code]) }
+        progress['missing'] = int(np.maximum(expected - observed, 0).sum())
+        progress['sample_counts'] = dict(zip(('nontarget', 'target'), recording_io.split_event_counts(self.events.sample_counts)))
+        if (self.first_mismatch is not None):
+            trials_shape = (self.participant_config['num_sequences'], self.participant_config['blocks_per_sequence'], self.participant_config['trials_per_block'])
+            mismatch = { 'trial_index': self.first_mismatch }
+            if (self.first_mismatch < self.planned.size):
+                sequence, block, trial = np.unravel_index(self.first_mismatch, trials_shape)
+                mismatch.update({ 'sequence': int(sequence), 'block': int(block), 'trial': int(trial) })
+            progress['first_mismatch'] = mismatch
+        return progress
+
+def format_progress(progress):
+    """
+    Returns a one line summary of RecordingMonitor.get_progress
+    """
+    codes = ', '.join('{0}: {1}/{2}'.format(code, counts['observed'], counts['expected']) for code, counts in progress['codes'].items())
+    text = 'Trials ({0}/{1}), samples ({2}) | {3}'.format(progress['trials'], progress['planned'], progress['samples'], codes)
+    if (progress['missing'] > 0):
+        text += ' | {0} missing'.format(progress['missing'])
+    if ('first_mismatch' in progress):
+        text += ' | first mismatch at trial {0}'.format(progress['first_mismatch']['trial_index'])
+    return text
+
+def follow_recording(participant_config, data_path, interval=1.0, idle_timeout=None, chunk_size=recording_io.DEFAULT_CHUNK_SIZE):
+    """
+    Follows a recording as it is written, printing progress whenever new
+    samples arrive, until every planned trial has been recorded, nothing
+    was appended for idle_timeout seconds or the user interrupts it.
+    Returns the final RecordingMonitor.get_progress
+    """
+    monitor = RecordingMonitor(participant_config, data_path)
+    last_data = time.monotonic()
+    try:
+        while (monitor.num_onsets < monitor.planned.size):
+            num_new = 0
+            # Catch up on everything appended since the last poll
+            while True:
+                num_samples = monitor.update(chunk_size)
+                if (num_samples == 0):
+                    break
+                num_new += num_samples
+            if (num_new > 0):
+                last_data = time.monotonic()
+                print(format_progress(monitor.get_progress()))
+            elif (idle_timeout is not None and time.monotonic() - last_data > idle_timeout):
+                print('No new samples for {0} seconds, stopping'.format(idle_timeout))
+                break
+            else:
+                time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    return monitor.get_progress()
+
+def count_recording_events(path, chunk_size=recording_io.DEFAULT_CHUNK_SIZE):
+    """
+    Streams a recording once and returns a dictionary of its number of
+    samples, the number of samples of each event code and the number of
+    onsets (trials) of each event code, as lists indexed by code
+    """
+    return recording_io.count_events(path, chunk_size).to_dict()
+
+def load_audit_cache(path):
+    """
+    Returns the audit cache of a data directory, mapping the path of each
+    recording (relative to the directory) to its signature and counts
+    """
+    try:
+        with open(os.path.join(path, AUDIT_CACHE_FILENAME), 'r') as fp:
+            cache = json.load(fp)
+    except (OSError, ValueError):
+        return {}
+    if (cache.get('version') != AUDIT_CACHE_VERSION):
+        return {}
+    return cache.get('recordings', {})
+
+def save_audit_cache(path, recordings):
+    file_path_name = os.path.join(path, AUDIT_CACHE_FILENAME)
+    with open(file_path_name + '.tmp', 'w') as fp:
+        json.dump({ 'version': AUDIT_CACHE_VERSION, 'recordings': recordings }, fp, indent=1, sort_keys=True)
+    os.replace(file_path_name + '.tmp', file_path_name)
+
+def get_recording_summary(name, counts, subjects_path=None):
+    """
+    Returns the report entry of one recording. If subjects_path is given,
+    the trials of each event code are compared with the participant's
+    SUBJECT_N.json file
+    """
+    nontarget, target = recording_io.split_event_counts(np.array(counts['sample_counts'], dtype=np.int64))
+    onset_counts = np.array(counts['onset_counts'], dtype=np.int64)
+    summary = { 'file': name, 'num_samples': counts['num_samples'], 'nontarget': nontarget, 'target': target,
+        'num_trials': int(onset_counts[1:].sum()), 'trials': { str(code): int(onset_counts[code]) for code in np.flatnonzero(onset_counts) } }
+
+    match = RECORDING_PATTERN.search(name)
+    if (subjects_path is None or match is None):
+        return summary
+    subject_path = os.path.join(subjects_path, 'SUBJECT_{0}.json'.format(match.group(1)))
+    if (not os.path.exists(subject_path)):
+        summary['errors'] = ['No subject file {0}'.format(subject_path)]
+        return summary
+
+    with open(subject_path, 'r') as fp:
+        expected_counts = np.bincount(get_planned_event_codes(json.load(fp)))
+    num_codes = max(expected_counts.size, onset_counts.size)
+    expected_counts = np.pad(expected_counts, (0, num_codes - expected_counts.size))
+    onset_counts = np.pad(onset_counts, (0, num_codes - onset_counts.size))
+    summary['expected_trials'] = { str(code): int(expected_counts[code]) for code in np.flatnonzero(expected_counts) }
+    summary['missing_trials'] = int(np.maximum(expected_counts - onset_counts, 0).sum())
+    summary['extra_trials'] = int(np.maximum(onset_counts - expected_counts, 0)[1:].sum())
+    return summary
+
+def audit_recordings(path, workers=1, subjects_path=None, force=False, chunk_size=recording_io.DEFAULT_CHUNK_SIZE):
+    """
+    Counts the events of every Subject_N_Data.csv recording under a data
+    directory across a pool of worker processes. Counts are cached in the
+    directory keyed on each recording's path, size and modification time,
+    so only new or changed recordings are parsed again.
+    Returns one report for the whole directory
+    """
+    names = sorted(os.path.relpath(recording_path, path) for recording_path in glob.glob(os.path.join(path, '**', 'Subject_*_Data.csv'), recursive=True))
+    cache = {} if force else load_audit_cache(path)
+    signatures = { name: recording_io.get_source_signature(os.path.join(path, name)) for name in names }
+    stale = [name for name in names if cache.get(name, {}).get('signature') != signatures[name]]
+
+    count = functools.partial(count_recording_events, chunk_size=chunk_size)
+    stale_paths = [os.path.join(path, name) for name in stale]
+    if (workers <= 1 or len(stale) <= 1):
+        results = [count(recording_path) for recording_path in stale_paths]
+    else:
+        # Only imported when a pool is needed, it is slow to import
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(count, stale_paths))
+    for name, counts in zip(stale, results):
+        cache[name] = dict(counts, signature=signatures[name])
+    # Forget recordings that were removed from the directory
+    cache = { name: cache[name] for name in names }
+    save_audit_cache(path, cache)
+
+    recordings = [get_recording_summary(name, cache[name], subjects_path) for name in names]
+    total_trials = {}
+    for recording in recordings:
+        for code, trials in recording['trials'].items():
+            total_trials[code] = total_trials.get(code, 0) + trials
+    report = { 'directory': path, 'num_recordings': len(recordings), 'num_parsed': len(stale),
+        'num_samples': sum(recording['num_samples'] for recording in recordings), 'trials': total_trials, 'recordings': recordings }
+    if (subjects_path is not None):
+        report['incomplete'] = [recording['file'] for recording in recordings
+            if recording.get('errors') or recording.get('missing_trials', 0) > 0 or recording.get('extra_trials', 0) > 0]
+    return report
+
+def verify_data_file(path, streaming=False, use_cache=False, chunk_size=recording_io.DEFAULT_CHUNK_SIZE):
     """
     Prints the number of non target and target trials
-    recorded inside a data.csv file
+    recorded inside a data.csv file.
+    In streaming mode only the event column is parsed, chunk_size bytes
+    at a time, so the recording is never loaded as a whole.
+    With use_cache the event column is read from the recording's binary
+    cache (see recording_io.load_recording)
     """
+    if (use_cache):
+        recording = recording_io.load_recording(path, chunk_size=chunk_size)
+        counts = recording_io.accumulate_event_counts(np.zeros(0, dtype=np.int64), np.asarray(recording.events, dtype=np.int64))
+        num_samples = recording.num_samples
+    elif (streaming):
+        counts, num_samples = recording_io.count_event_codes(path, chunk_size)
+    if (use_cache or streaming):
+        nontarget, target = recording_io.split_event_counts(counts)
+        print((num_samples,))
+        print(nontarget)
+        print(target)
+        return
+
     eeg_data = np.genfromtxt(path, delimiter=',')
     event_channel = eeg_data[:,1]
     print(event_channel.shape)
@@ -61,7 +553,89 @@ def verify_data_file(path):
     print(nontarget)
     print(target)
 
+if (__name__ == '__main__'):
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subject_parser = subparsers.add_parser('subject', help='Print the trial counts of a SUBJECT_N.json file')
+    subject_parser.add_argument('path', help='Path to the subject file', type=str)
+
+    directory_parser = subparsers.add_parser('directory', help='Validate every SUBJECT_*.json file in a directory')
+    directory_parser.add_argument('path', help='Directory holding the subject files', type=str)
+    directory_parser.add_argument('--workers', help='Number of processes used to validate files', \
+        type=int, default=os.cpu_count())
+    directory_parser.add_argument('--min_target_separation', help='Minimum number of trials between \
+        two consecutive targets', type=int, default=0)
+    directory_parser.add_argument('--max_target_separation', help='Maximum number of trials between \
+        two consecutive targets', type=int, default=None)
+    directory_parser.add_argument('--packed', help='Validate the packed {0} subject files instead of the json files'.format(packed_subject_file.PACKED_EXTENSION), \
+        action='store_true', default=False)
+    directory_parser.add_argument('--out', help='Write the summary to this file instead of printing it', \
+        type=str, default=None)
+
+    align_parser = subparsers.add_parser('align', help='Check the events of a recording against the trials of its subject file')
+    align_parser.add_argument('subject_path', help='Path to the SUBJECT_N.json file', type=str)
+    align_parser.add_argument('data_path', help='Path to the Subject_N_Data.csv recording', type=str)
+    align_parser.add_argument('--band', help='Number of trials the recording may drift from the plan', type=int, default=50)
 
+    follow_parser = subparsers.add_parser('follow', help='Follow a recording while it is written and compare it with its subject file')
+    follow_parser.add_argument('subject_path', help='Path to the SUBJECT_N.json file', type=str)
+    follow_parser.add_argument('data_path', help='Path to the Subject_N_Data.csv recording', type=str)
+    follow_parser.add_argument('--interval', help='Seconds between checks for new samples', type=float, default=1.0)
+    follow_parser.add_argument('--idle_timeout', help='Stop after this many seconds without new samples', type=float, default=None)
+    follow_parser.add_argument('--chunk_size', help='Number of bytes read at a time', \
+        type=int, default=recording_io.DEFAULT_CHUNK_SIZE)
 
+    audit_parser = subparsers.add_parser('audit', help='Count the events of every recording in a data directory')
+    audit_parser.add_argument('path', help='Directory holding the Subject_N_Data.csv recordings', type=str)
+    audit_parser.add_argument('--subjects', help='Directory of SUBJECT_N.json files to compare the trial counts with', \
+        type=str, default=None)
+    audit_parser.add_argument('--workers', help='Number of processes used to parse recordings', \
+        type=int, default=os.cpu_count())
+    audit_parser.add_argument('--force', help='Parse every recording again, ignoring the cached counts', \
+        action='store_true', default=False)
+    audit_parser.add_argument('--chunk_size', help='Number of bytes read at a time', \
+        type=int, default=recording_io.DEFAULT_CHUNK_SIZE)
+    audit_parser.add_argument('--out', help='Write the report to this file instead of printing it', \
+        type=str, default=None)
 
+    data_parser = subparsers.add_parser('data', help='Print the event counts of a Subject_N_Data.csv recording')
+    data_parser.add_argument('path', help='Path to the recording', type=str)
+    data_parser.add_argument('--stream', help='Parse the recording in chunks instead of loading it whole', \
+        action='store_true', default=False)
+    data_parser.add_argument('--cache', help='Read the recording from its binary cache, building it if needed', \
+        action='store_true', default=False)
+    data_parser.add_argument('--chunk_size', help='Number of bytes read at a time when streaming', \
+        type=int, default=recording_io.DEFAULT_CHUNK_SIZE)
+    args = parser.parse_args()
 
+    if (args.command == 'subject'):
+        with open(args.path, 'r') as fp:
+            print_actual_sequence_info(json.load(fp))
+    elif (args.command == 'directory'):
+        max_target_separation = math.inf if args.max_target_separation is None else args.max_target_separation
+        summary = validate_subject_directory(args.path, args.workers, args.min_target_separation, max_target_separation, args.packed)
+        if (args.out is None):
+            print(json.dumps(summary, indent=2))
+        else:
+            with open(args.out, 'w') as fp:
+                json.dump(summary, fp, indent=2)
+            print('{0} of {1} subject files are valid'.format(summary['num_valid'], summary['num_subjects']))
+    elif (args.command == 'align'):
+        with open(args.subject_path, 'r') as fp:
+            summary = check_recorded_sequence(json.load(fp), args.data_path, args.band)
+        print(json.dumps(summary, indent=2))
+    elif (args.command == 'follow'):
+        with open(args.subject_path, 'r') as fp:
+            progress = follow_recording(json.load(fp), args.data_path, args.interval, args.idle_timeout, args.chunk_size)
+        print(json.dumps(progress, indent=2))
+    elif (args.command == 'audit'):
+        report = audit_recordings(args.path, args.workers, args.subjects, args.force, args.chunk_size)
+        if (args.out is None):
+            print(json.dumps(report, indent=2))
+        else:
+            with open(args.out, 'w') as fp:
+                json.dump(report, fp, indent=2)
+            print('Audited {0} recordings ({1} parsed)'.format(report['num_recordings'], report['num_parsed']))
+    elif (args.command == 'data'):
+        verify_data_file(args.path, streaming=args.stream, use_cache=args.cache, chunk_size=args.chunk_size)